@@ -72,6 +72,32 @@
 #% required: no
 #%end
 
+#%option
+#% key: resistances
+#% type: string
+#% gisprompt: new_file,file,output
+#% description: Output file for the pairwise effective resistance matrix (pairwise mode only, no current or voltage maps will be created)
+#% required: no
+#%end
+
+#%option
+#% key: resformat
+#% type: string
+#% answer: csv
+#% options: csv, npy
+#% description: Resistance matrix file format (npy is a binary NumPy array with feature categories in the first row and column)
+#% required: no
+#%end
+
+#%option
+#% key: gridformat
+#% type: string
+#% answer: ascii
+#% options: ascii, npy
+#% description: Raster exchange format with Circuitscape (npy is binary and requires Circuitscape 4 or newer)
+#% required: no
+#%end
+
 #%option
 #% key: connecttype
 #% type: string
@@ -81,6 +107,69 @@
 #% required: no
 #%end
 
+#%option
+#% key: maxdist
+#% type: double
+#% description: Pairwise mode: solve only pairs of features closer than this Euclidean distance (in map units)
+#% required: no
+#%end
+
+#%option
+#% key: nearest
+#% type: integer
+#% description: Pairwise mode: solve only pairs where one feature is among the given number of nearest features of the other
+#% required: no
+#%end
+
+#%option
+#% key: pairfile
+#% type: string
+#% gisprompt: old_file,file,input
+#% description: Pairwise mode: text file of feature pairs (two feature cats on each line) to be included or excluded
+#% required: no
+#%end
+
+#%option
+#% key: pairmode
+#% type: string
+#% answer: include
+#% options: include, exclude
+#% description: Whether the pairs in the pair file are included or excluded
+#% required: no
+#%end
+
+#%option
+#% key: workers
+#% type: integer
+#% answer: 1
+#% description: Number of Circuitscape processes solving the pairs in parallel in pairwise mode (requires Circuitscape version supporting included pairs files)
+#% required: no
+#%end
+
+#%option
+#% key: coarsen
+#% type: integer
+#% answer: 1
+#% description: Pairwise mode: block size (in cells) of the adaptive circuit. Blocks near features are solved at full resolution, other blocks as single nodes (1 means no coarsening)
+#% required: no
+#%end
+
+#%option
+#% key: finedist
+#% type: double
+#% answer: 0
+#% description: Pairwise mode: distance from features (in map units) within which blocks are kept at full resolution (blocks containing features always are)
+#% required: no
+#%end
+
+#%option
+#% key: nprocs
+#% type: integer
+#% answer: 4
+#% description: Number of parallel raster import processes
+#% required: no
+#%end
+
 #%flag
 #% key: m
 #% description: Low memory mode for pairwise mode (requires less memory, but takes longer)
@@ -122,11 +211,15 @@
 #%end
 
 import subprocess
-import atexit, sys, os
+import atexit, sys, os, time
+import numpy
 import grass.script as grass
+from grass.script import array as garray
 import grass.lib.vector as vect
 import grass.lib.gis as gis
 
+NODATA = -9999  # NoData value used in grid files exchanged with Circuitscape
+POLL_INTERVAL = 1   # Seconds between checks for new Circuitscape result files
 
 def main():
     # Some preliminaries: get working environment settings
@@ -167,33 +260,73 @@ def main():
     elif maptype == "Both":
         voltagemap = "True"
         currentmap = "True"
+    resistances = options['resistances']    # Effective resistance matrix output file
+    resformat = options['resformat']        # Effective resistance matrix file format: csv or npy
+    if resistances:
+        if scenario != "pairwise":
+            grass.fatal("Effective resistance matrix can only be calculated in pairwise mode")
+        # No maps are needed, so Circuitscape will only solve the pairs and write the resistances
+        currentmap = "False"
+        voltagemap = "False"
+    gridformat = options['gridformat']  # Raster exchange format: ascii or npy
+    workers = int(options['workers'])   # Number of parallel Circuitscape processes
+    nprocs = int(options['nprocs'])     # Number of parallel import processes
+    coarsen = int(options['coarsen'])   # Block size of the adaptive circuit
+    finedist = float(options['finedist']) if options['finedist'] else 0    # Distance from features within which full resolution is kept
+    if workers < 1 or nprocs < 1 or coarsen < 1:
+        grass.fatal("The number of workers, import processes and block size must be positive numbers")
+    # With coarsening, the circuit is built here as a graph and solved in Circuitscape network mode, which supports pairwise mode only
+    adaptive = coarsen > 1
+    if adaptive and scenario != "pairwise":
+        grass.fatal("Coarsening is only available in pairwise mode")
     poly = True if flags["p"] else False    # Vector layer contains polygons
     overw = True if flags["o"] else False   # Overwrite output layers if needed
-    # The pair inclusion/exclusion matrix is not actually implemented here as the feature does not seem to work with Circuitscape version 3.5.8. The option is nevertheless retained here for future developments.
-    # pairfile = "None" if not options['pairfile'] else options['pairfile']
-    pairfile = "None"
+    # Pair selection in pairwise mode. Selected pairs are passed to Circuitscape as an included pairs file (note that this does not seem to work with Circuitscape version 3.5.8)
+    maxdist = float(options['maxdist']) if options['maxdist'] else 0    # Maximum distance between pair features
+    nearest = int(options['nearest']) if options['nearest'] else 0     # Number of nearest features to be paired with
+    userpairs = options['pairfile']     # User pair file
+    pairmode = options['pairmode']      # Include or exclude pairs in user pair file
+    pairfile = "None"                   # Circuitscape included pairs file, "None" if all pairs are solved
+    # In pairwise mode the cumulative and maximum current maps are summed up here as each pair map is written by Circuitscape, so that pair maps can be removed straight away instead of piling up on the disk. This is needed only if pair maps are written anyway, results of several Circuitscape processes are merged, pairs are selected or node values of the adaptive circuit are mapped back to the grid; otherwise Circuitscape sums up the cumulative map in memory
+    streaming = (scenario == "pairwise") and not resistances and (not flags["c"] or voltagemap == "True" or workers > 1 or bool(maxdist or nearest or userpairs) or adaptive)
 
     # Some temporary layers
     tmp_featraster = "tmp_circuitscape_featraster"     # Temporary layer name for rasterised vector layer
-    cost_ascii = tmppath + "cost.asc"                  # Cost surface ascii file path and name
-    feats_ascii = tmppath + "feats.asc"                # Rasterised ascii vector layer file path and name
+    gridext = "." + ("npy" if gridformat == "npy" else "asc")
+    cost_grid = tmppath + "cost" + gridext             # Cost surface grid file path and name
+    feats_grid = tmppath + "feats" + gridext           # Rasterised vector layer grid file path and name
 
     # Output settings
     output_prefix = options['prefix']                           # The prefix will be added to the output files
     cs_output = tmppath + output_prefix + ".out"                # The general output file path and name template
     cs_output_cum = tmppath + output_prefix + "_cum_curmap.asc" # The cumulative current map path and name
+    graph_file = tmppath + output_prefix + "_graph.txt"         # Adaptive circuit graph file path and name
+    focal_file = tmppath + output_prefix + "_focal.txt"         # Focal node list file path and name for network mode
 
     # Get the number of features and the list of possible pairs
     featlist, pairlist = featpairs(features)
     n_feats = len(featlist)
+
+    # Leave out the pairs that are not needed and write the rest into an included pairs file for Circuitscape
+    if scenario == "pairwise" and (maxdist or nearest or userpairs):
+        pairlist = selectpairs(features, poly, featlist, pairlist, maxdist, nearest, userpairs, pairmode)
+        if not pairlist:
+            grass.fatal("No feature pairs left to be solved")
+        grass.message(str(len(pairlist)) + " feature pairs selected")
+        pairfile = tmppath + output_prefix + "_pairs.txt"
+        write_pairfile(pairfile, featlist, pairlist)
     
-    # Convert the input features and cost raster into ASCII raster
-    grass.run_command('r.out.arc', overwrite=True, input=cost, output=cost_ascii)
+    # Convert the input features and cost raster into grid files, or with coarsening, into an adaptive circuit graph: blocks of coarsen x coarsen cells near features keep a node for every cell, other blocks become single nodes. Circuitscape then solves a much smaller circuit
     if poly:
         grass.run_command('v.to.rast', overwrite=True, input=features, type="area", output=tmp_featraster, use="cat")
     else:
         grass.run_command('v.to.rast', overwrite=True, input=features, type="point", output=tmp_featraster, use="cat")
-    grass.run_command('r.out.arc', overwrite=True, input=tmp_featraster, output=feats_ascii)
+    if adaptive:
+        graph = AdaptiveGraph(cost, tmp_featraster, coarsen, finedist, costtype == "True", connecttype == "True", flags["r"])
+        graph.write(graph_file, focal_file)
+    else:
+        export_grid(cost, cost_grid, gridformat)
+        export_grid(tmp_featraster, feats_grid, gridformat)
     
     
     """ Circuitscape-specific settings """
@@ -213,16 +346,16 @@ def main():
     
     # Options for pairwise and one-to-all and all-to-one modes
     included_pairs_file = pairfile
-    point_file_contains_polygons = str(poly)
+    point_file_contains_polygons = "False" if adaptive else str(poly)   # Graph focal nodes are single nodes
     use_included_pairs = "False" if pairfile == "None" else "True"
-    point_file = feats_ascii
+    point_file = focal_file if adaptive else feats_grid
 
     # Output options
-    write_cum_cur_map_only = "True" if flags["c"] else "False"
-    log_transform_maps = "True" if flags["l"] else "False"
+    write_cum_cur_map_only = "True" if (flags["c"] and not resistances and not streaming) else "False"
+    log_transform_maps = "True" if (flags["l"] and not streaming) else "False"    # When streaming, the pair maps are needed untransformed for summing up
     set_focal_node_currents_to_zero = "False"
     output_file = cs_output
-    write_max_cur_maps = "True" if flags["x"] else "False"
+    write_max_cur_maps = "True" if (flags["x"] and not resistances and not streaming) else "False"
     write_volt_maps = voltagemap
     set_null_currents_to_nodata = "False" if flags["n"] else "True"
     set_null_voltages_to_nodata = "False" if flags["n"] else "True"
@@ -238,8 +371,8 @@ def main():
     connect_using_avg_resistances = connecttype
 
     # Habitat raster or graph
-    habitat_file = cost_ascii
-    habitat_map_is_resistances = costtype
+    habitat_file = graph_file if adaptive else cost_grid
+    habitat_map_is_resistances = "True" if adaptive else costtype   # Graph edges are written as resistances
 
     # Options for one-to-all and all-to-one modes
     use_variable_source_strengths = "False"
@@ -253,7 +386,7 @@ def main():
     mask_file = "None"
 
     # Circuitscape mode
-    data_type = "raster"
+    data_type = "network" if adaptive else "raster"
     scenario = scenario
 
     # The following long string is a properly formatted .ini file for Circuitscape
@@ -322,59 +455,123 @@ def main():
     ini.write(inistring)
     ini.close()
 
-    # Finally run Circuitscape
-    try:
-        cs = subprocess.check_call([CS_Path, inipath], shell=False)
-    except:
-        print("Error with running Circuitscape")
-
-
-    # Import results into GRASS
-
-    # Import cumulative current map
-    curmap_cum_in = tmppath + output_prefix + "_cum_curmap.asc"
-    curmap_cum_out = output_prefix + "_" + "cumulative"
-    grass.run_command('r.in.gdal', flags="o", overwrite=overw, input=curmap_cum_in, output=curmap_cum_out)
-
-    # If the maximum current map flag ("x") is checked, import that too
-    if flags["x"]:
-        max_curmap_in = tmppath + output_prefix + "_max_curmap.asc"
-        max_curmap_out = output_prefix + "_" + "maxcurrent"
-        grass.run_command('r.in.gdal', flags="o", overwrite=overw, input=curmap_cum_in, output=max_curmap_out)
-
-    # If "write cumulative current map only" flag ("c") is NOT checked AND current maps are created, import all current maps
-    if (not flags["c"]) and (maptype == "Current" or maptype == "Both"):
-        if scenario == "pairwise":  # for pairwise mode, there's going to be a lot more maps
-            for pair in pairlist:    # import current maps with all possible pairs
-                curpair_in = tmppath + output_prefix + "_curmap_" + pair + ".asc"    # The path and filename of circuitscape generated current pair map
-                curpair_out = output_prefix + "_cur_" + pair     # The output name for r.in.gdal that imports current pair maps into GRASS
-                grass.run_command('r.in.gdal', flags="o", overwrite=overw, input=curpair_in, output=curpair_out)
-        else:   # for all-to-one, or one-to-all mode
-            for feat in featlist:    # Iterate through all features
-                curmap_in = tmppath + output_prefix + "_curmap_" + str(feat) + ".asc"
-                curmap_out = output_prefix + "_cur_" + str(feat)
-                grass.run_command('r.in.gdal', flags="o", overwrite=overw, input=curmap_in, output=curmap_out)
-
-    # If voltage map are created, import them
-    if maptype == "Voltage" or maptype == "Both":
-        if scenario == "pairwise":
-            for pair in pairlist:
-                voltpair_in = tmppath + output_prefix + "_voltmap_" + pair + ".asc"    # The path and filename of circuitscape generated voltage pair map
-                voltpair_out = output_prefix + "_volt_" + pair     # The output name for r.in.gdal that imports current pair maps into GRASS
-                grass.run_command('r.in.gdal', flags="o", overwrite=overw, input=voltpair_in, output=voltpair_out)
+    # In pairwise mode the pairs can be split between several Circuitscape processes. Each of them gets its own .ini file, output file name and included pairs file, all starting with the output prefix so that they are cleaned up with the rest of temporary files
+    runs = [(inipath, output_prefix, set(pairlist))]    # A list of (ini file, output file prefix, pairs to be solved) tuples, one for each Circuitscape process
+    if scenario == "pairwise" and (workers > 1 or pairfile != "None"):
+        grass.warning("Pair selection and parallel pairwise mode rely on included pairs files, which are not supported by Circuitscape 3.5.8")
+    if scenario == "pairwise" and workers > 1:
+        runs = []
+        for i, chunk in enumerate(pairchunks(pairlist, workers)):
+            run_prefix = output_prefix + "_part" + str(i + 1)
+            run_pairfile = tmppath + run_prefix + "_pairs.txt"
+            write_pairfile(run_pairfile, featlist, chunk)
+            run_inipath = tmppath + run_prefix + ".ini"
+            ini = open(run_inipath, "w")
+            ini.write(ini_set(inistring, output_file = tmppath + run_prefix + ".out", included_pairs_file = run_pairfile, use_included_pairs = "True"))
+            ini.close()
+            runs.append((run_inipath, run_prefix, set(chunk)))
+
+    # Finally run Circuitscape. Result maps are collected while Circuitscape is still running and handed over to a pool of background import processes, which also delete the files they have imported
+    importer = ImportPool(nprocs)
+    processes = [subprocess.Popen([CS_Path, run_inipath], shell=False) for run_inipath, run_prefix, run_pairs in runs]
+    if not resistances:
+        accumulator = CurrentAccumulator()
+        skipped = set()     # Pairs solved by Circuitscape that were not selected
+        watchers = [ResultWatcher(tmppath, run_prefix, adaptive) for run_inipath, run_prefix, run_pairs in runs]
+        while True:
+            running = False
+            readylist = []
+            for cs, watcher, run in zip(processes, watchers, runs):
+                finished = cs.poll() is not None
+                running = running or not finished
+                readylist.extend([(run, kind, key, filename) for kind, key, filename in watcher.ready(final = finished)])
+            for run, kind, key, filename in readylist:
+                if streaming:   # Pairwise mode: pair maps are summed up here and written into GRASS from memory
+                    key = "_".join(sorted(key.split("_"), key=int))    # Pair keys in the same form as in the pair list
+                    # Each process must solve only the pairs of its own chunk. If it solves others, its included pairs file has been ignored and the pairs would be summed up more than once
+                    if workers > 1 and key not in run[2]:
+                        for cs in processes:
+                            if cs.poll() is None:
+                                cs.kill()
+                        grass.fatal("Circuitscape solved pair " + key + " that was not in its included pairs file. Parallel pairwise mode needs included pairs files, which are not supported by Circuitscape 3.5.8")
+                    # With a single process, pairs left out by pair selection are skipped here in case Circuitscape has ignored the included pairs file
+                    if key not in run[2]:
+                        os.remove(filename)
+                        if not skipped:
+                            grass.warning("Circuitscape solved pairs that were not selected. They are left out of the results")
+                        skipped.add(key)
+                        continue
+                    if adaptive:    # Node values of the adaptive circuit are mapped back to the grid
+                        data = graph.grid(filename, kind == "curmap", 0 if flags["n"] else NODATA)
+                        branchfile = filename.replace("_node_currents_", "_branch_currents_")
+                        if kind == "curmap" and os.path.exists(branchfile):     # Branch currents are not used
+                            os.remove(branchfile)
+                    else:
+                        data = read_grid(filename)
+                    os.remove(filename)     # The pair map is not needed anymore
+                    rawfile = os.path.splitext(filename)[0] + ".bin"
+                    if kind == "curmap":
+                        accumulator.add(data)
+                        # Write current pair maps into GRASS only if "write cumulative current map only" flag ("c") is NOT checked
+                        if not flags["c"]:
+                            write_grid(importer, data, output_prefix + "_cur_" + key, overw, flags["l"], rawfile)
+                    elif voltagemap == "True":
+                        write_grid(importer, data, output_prefix + "_volt_" + key, overw, False, rawfile)
+                else:   # One-to-all and all-to-one modes: feature maps are imported as they are
+                    if kind == "curmap" and not flags["c"]:
+                        import_grid(importer, filename, output_prefix + "_cur_" + key, overw)
+                    elif kind == "voltmap" and voltagemap == "True":
+                        import_grid(importer, filename, output_prefix + "_volt_" + key, overw)
+                    else:
+                        os.remove(filename)
+            importer.collect()
+            if not running:
+                break
+            time.sleep(POLL_INTERVAL)
+    for cs in processes:
+        if cs.wait() != 0:
+            print("Error with running Circuitscape")
+
+
+    # If only the effective resistances were asked for, write the resistance matrix and skip map import altogether
+    if resistances:
+        matrices = [numpy.loadtxt(tmppath + run_prefix + "_resistances.out", dtype=numpy.float64, ndmin=2) for run_inipath, run_prefix, run_pairs in runs]
+        if len(runs) == 1:
+            write_resistances(matrices[0], resistances, resformat)
         else:
-            for feat in featlist:
-                voltmap_in = tmppath + output_prefix + "_voltmap_" + str(feat) + ".asc"
-                voltmap_out = output_prefix + "_volt_" + str(feat)
-                grass.run_command('r.in.gdal', flags="o", overwrite=overw, input=voltmap_in, output=voltmap_out)
+            write_resistances(merge_resistances(matrices, featlist), resistances, resformat)
 
+    # In pairwise mode pair maps are already being imported, so only the cumulative and maximum current maps are left to be written
+    elif streaming:
+        if currentmap == "True":
+            cumulative, maximum = accumulator.result()
+            write_grid(importer, cumulative, output_prefix + "_" + "cumulative", overw, flags["l"], tmppath + output_prefix + "_cumulative.bin")
+            if flags["x"]:
+                write_grid(importer, maximum, output_prefix + "_" + "maxcurrent", overw, flags["l"], tmppath + output_prefix + "_maxcurrent.bin")
+
+    # Otherwise (all-to-one or one-to-all mode, or pairwise mode with cumulative map only) import cumulative and maximum current maps written by Circuitscape
+    else:
+        curmap_cum_in = find_grid(tmppath + output_prefix + "_cum_curmap")
+        curmap_cum_out = output_prefix + "_" + "cumulative"
+        import_grid(importer, curmap_cum_in, curmap_cum_out, overw)
+
+        # If the maximum current map flag ("x") is checked, import that too
+        if flags["x"]:
+            max_curmap_in = find_grid(tmppath + output_prefix + "_max_curmap")
+            max_curmap_out = output_prefix + "_" + "maxcurrent"
+            import_grid(importer, max_curmap_in, max_curmap_out, overw)
+
+    # Wait for the remaining imports to finish
+    importer.wait()
 
     # Delete temporary files
     filelist = [ file for file in os.listdir(tmppath) if file.startswith(output_prefix) ]    # Create a list of files in tmp dir that starts with our prefix
     for file in filelist:   # Delete each file in the tmpdir that is specified in the filelist created previously
         os.remove(tmppath+file)
-    os.remove(cost_ascii)   # Delete ascii cost raster
-    os.remove(feats_ascii)  # Delete ascii features raster
+    for gridfile in ([] if adaptive else [cost_grid, feats_grid]):    # Delete cost and features grids (and their headers if binary format was used)
+        os.remove(gridfile)
+        if gridformat == "npy":
+            os.remove(os.path.splitext(gridfile)[0] + ".hdr")
     grass.run_command('g.remove', rast = tmp_featraster)    # And finally get rid of the temporary rasterised feature layer
 
 
@@ -392,6 +589,394 @@ def featpairs(vectlayer):
     return featlist, pairlist    # Return feature count and the pair list
 
 
+def selectpairs(vectlayer, poly, featlist, pairlist, maxdist, nearest, userpairs, pairmode):
+    # Method returning the pairs of pairlist that pass all pair selection rules: Euclidean distance (between points or area centroids) not over maxdist, one feature among nearest closest features of the other, and listed (or not listed) in user pair file
+    coordsdict = featcoords(vectlayer, poly)
+    cats = sorted(featlist)
+    index = dict((cat, i) for i, cat in enumerate(cats))
+    coords = numpy.array([coordsdict[cat] for cat in cats], dtype=numpy.float64)
+    dist = numpy.sqrt(((coords[:,numpy.newaxis,:] - coords[numpy.newaxis,:,:])**2).sum(axis=2))  # Distance matrix
+    selected = numpy.ones(dist.shape, dtype=bool)
+    if maxdist:
+        selected &= dist <= maxdist
+    if nearest:
+        near = numpy.zeros(dist.shape, dtype=bool)
+        order = numpy.argsort(dist, axis=1)[:,1:nearest+1]  # Nearest features of each feature (column 0 is the feature itself)
+        near[numpy.arange(len(cats))[:,numpy.newaxis], order] = True
+        selected &= near | near.T
+    if userpairs:
+        listed = numpy.zeros(dist.shape, dtype=bool)
+        for line in open(userpairs):
+            values = line.replace(",", " ").split()
+            try:
+                cat, cat2 = int(values[0]), int(values[1])
+            except (IndexError, ValueError):    # Skip empty, header and other unparseable lines
+                continue
+            if cat in index and cat2 in index:
+                feat, feat2 = index[cat], index[cat2]
+                listed[feat, feat2] = listed[feat2, feat] = True
+        selected &= listed if pairmode == "include" else ~listed
+    pairs = []
+    for pair in pairlist:
+        feat, feat2 = [index[int(cat)] for cat in pair.split("_")]
+        if selected[feat, feat2]:
+            pairs.append(pair)
+    return pairs
+
+
+def featcoords(vectlayer, poly):
+    # Method creating a dict() of feature coordinates (area centroids if the layer contains polygons): {cat:(x,y)...}
+    ascii = grass.read_command('v.out.ascii', input=vectlayer, type="centroid" if poly else "point", format="point", separator="|")
+    coordsdict = {}
+    for line in ascii.splitlines():
+        values = line.split("|")
+        if len(values) >= 3:
+            coordsdict[int(values[2])] = (float(values[0]), float(values[1]))
+    return coordsdict
+
+
+def export_grid(mapname, filename, gridformat):
+    # Method writing a raster map into a grid file for Circuitscape. The binary format is a NumPy array accompanied by an ASCII grid style header file (.hdr) with the same name, so no text formatting of cell values is needed
+    if gridformat != "npy":
+        grass.run_command('r.out.arc', overwrite=True, input=mapname, output=filename)
+        return
+    region = grass.region()
+    if abs(region['nsres'] - region['ewres']) > 1e-9 * region['ewres']:
+        grass.fatal("Binary grid exchange requires square cells (nsres = ewres)")
+    data = garray.array()
+    data.read(mapname, null=NODATA)
+    numpy.save(filename, data)
+    header = open(os.path.splitext(filename)[0] + ".hdr", "w")
+    header.write("ncols " + str(region['cols']) + "\n" +
+                 "nrows " + str(region['rows']) + "\n" +
+                 "xllcorner " + repr(region['w']) + "\n" +
+                 "yllcorner " + repr(region['s']) + "\n" +
+                 "cellsize " + repr(region['ewres']) + "\n" +
+                 "NODATA_value " + str(NODATA) + "\n")
+    header.close()
+
+
+def find_grid(basename):
+    # Method returning the name of a Circuitscape result grid file: binary .npy grid if there is one, ASCII grid otherwise
+    if os.path.exists(basename + ".npy"):
+        return basename + ".npy"
+    return basename + ".asc"
+
+
+def import_grid(importer, filename, mapname, overwrite):
+    # Method starting the import of a Circuitscape result grid file into GRASS. Binary .npy grid is written out as raw data for r.in.bin, ASCII grid is imported with r.in.gdal
+    if filename.endswith(".npy"):
+        write_grid(importer, numpy.load(filename), mapname, overwrite, False, os.path.splitext(filename)[0] + ".bin")
+        os.remove(filename)
+    else:
+        importer.start([filename], 'r.in.gdal', flags="o", overwrite=overwrite, input=filename, output=mapname, quiet=True)
+
+
+def read_grid(filename):
+    # Method reading a Circuitscape result grid (NumPy binary or ASCII) into a NumPy array
+    if filename.endswith(".npy"):
+        return numpy.load(filename)
+    return numpy.loadtxt(filename, skiprows=6, ndmin=2)   # ASCII grid has 6 header lines
+
+
+def write_grid(importer, data, mapname, overwrite, log, rawfile):
+    # Method starting the import of a result grid array into GRASS raster map, optionally log10 transformed (as Circuitscape would do it). The array is written into a raw binary file which is removed after import
+    if log:
+        positive = data > 0
+        data = numpy.where(positive, numpy.log10(numpy.where(positive, data, 1)), NODATA)
+    numpy.asarray(data, dtype=numpy.float64).tofile(rawfile)
+    region = importer.region
+    importer.start([rawfile], 'r.in.bin', flags="d", overwrite=overwrite, input=rawfile, output=mapname, anull=NODATA,
+                   north=region['n'], south=region['s'], east=region['e'], west=region['w'], rows=region['rows'], cols=region['cols'], quiet=True)
+
+
+class AdaptiveGraph:
+    """ AdaptiveGraph object, builds a circuit graph of the cost surface for Circuitscape network mode: blocks of blocksize x blocksize cells that contain features or lie within finedist of them keep a node for every cell, other blocks become single nodes. All cells of a feature are one focal node (shorted, as polygons are in raster mode), named by the feature cat. Node values solved by Circuitscape are mapped back to the grid """
+    def __init__(self, cost, featraster, blocksize, finedist, resistance, avgresistance, fourneighbours):
+        region = grass.region()
+        rows, cols = region['rows'], region['cols']
+        self.blocksize = blocksize
+        self.avgresistance = avgresistance
+        # Read the cost surface with a null value below its range. Cells with null or non-positive cost are left out of the circuit
+        info = grass.raster_info(cost)
+        if info['min'] is None:
+            grass.fatal("Raster " + cost + " has no non-null cells")
+        nullvalue = float(info['min']) - 1
+        data = garray.array()
+        data.read(cost, null=nullvalue)
+        valid = (data != nullvalue) & (data > 0)
+        # The cell values that are averaged when cells are connected: resistances or conductances, depending on the connect type
+        values = numpy.ones((rows, cols))
+        values[valid] = data[valid] if resistance == avgresistance else 1 / data[valid]
+        del data
+        feats = garray.array()
+        feats.read(featraster, null=0)  # Feature cats are positive
+        feats = numpy.where(valid, feats, 0).astype(numpy.int64)
+        if not feats.any():
+            grass.fatal("No features on non-null cells of " + cost)
+
+        # Blocks with features, and blocks within finedist of them, are kept at full resolution
+        brows, bcols = (rows + blocksize - 1) // blocksize, (cols + blocksize - 1) // blocksize
+        featrows, featcols = numpy.nonzero(feats)
+        featblocks = numpy.zeros((brows, bcols), dtype=bool)
+        featblocks[featrows // blocksize, featcols // blocksize] = True
+        fineblocks = featblocks.copy()
+        reach = int(finedist / (blocksize * min(region['nsres'], region['ewres'])))
+        for dy in range(-min(reach, brows - 1), min(reach, brows - 1) + 1):
+            for dx in range(-min(reach, bcols - 1), min(reach, bcols - 1) + 1):
+                if (dy * blocksize * region['nsres'])**2 + (dx * blocksize * region['ewres'])**2 <= finedist**2:
+                    fineblocks[max(dy, 0):brows + min(dy, 0), max(dx, 0):bcols + min(dx, 0)] |= featblocks[max(-dy, 0):brows + min(-dy, 0), max(-dx, 0):bcols + min(-dx, 0)]
+        blockrow = numpy.arange(rows) // blocksize
+        blockcol = numpy.arange(cols) // blocksize
+        fine = fineblocks[blockrow[:, numpy.newaxis], blockcol[numpy.newaxis, :]]
+
+        # Block values: geometric means of the valid cells of each block, which (unlike arithmetic means) neither favour resistances nor conductances of a varied block
+        padded = numpy.zeros((brows * blocksize, bcols * blocksize))
+        padded[:rows, :cols] = numpy.where(valid, numpy.log(values), 0)
+        blocksums = padded.reshape(brows, blocksize, bcols, blocksize).sum(axis=(1, 3))
+        padded[:rows, :cols] = valid
+        blockcounts = padded.reshape(brows, blocksize, bcols, blocksize).sum(axis=(1, 3))
+        del padded
+        self.blockvalues = numpy.exp(blocksums / numpy.maximum(blockcounts, 1))
+
+        # Node ids: features are named by their cats, then come full resolution cells and coarse blocks
+        self.nodes = numpy.where(valid, feats, -1)
+        next_id = int(feats.max()) + 1
+        finecells = valid & fine & (feats == 0)
+        self.nodes[finecells] = numpy.arange(next_id, next_id + finecells.sum())
+        next_id += int(finecells.sum())
+        self.firstcoarse = next_id      # Nodes from this id on are coarse blocks
+        coarseblocks = ~fineblocks & (blockcounts > 0)
+        self.blocknodes = numpy.full((brows, bcols), -1, dtype=numpy.int64)
+        self.blocknodes[coarseblocks] = numpy.arange(next_id, next_id + coarseblocks.sum())
+        coarsecells = valid & ~fine
+        self.nodes[coarsecells] = self.blocknodes[blockrow[:, numpy.newaxis], blockcol[numpy.newaxis, :]][coarsecells]
+        next_id += int(coarseblocks.sum())
+        self.focal = numpy.unique(feats[feats > 0])
+        n_nodes = len(self.focal) + next_id - int(feats.max()) - 1
+        del feats, finecells, coarsecells
+
+        # Edges of cells: every pair of neighbouring cells of which at least one is at full resolution. A coarse cell stands for its block, seen from the block edge, so its value is the block value over blocksize cells of length
+        offsets = [(0, 1), (1, 0)] if fourneighbours else [(0, 1), (1, 0), (1, 1), (1, -1)]
+        ends, conductances = [], []
+        for dy, dx in offsets:
+            source = (slice(0, rows - dy), slice(max(-dx, 0), cols - max(dx, 0)))
+            target = (slice(dy, rows), slice(max(dx, 0), cols + min(dx, 0)))
+            edges = valid[source] & valid[target] & (fine[source] | fine[target]) & (self.nodes[source] != self.nodes[target])
+            erows, ecols = numpy.nonzero(edges)
+            terms = []
+            for row, col in ((erows, ecols + max(-dx, 0)), (erows + dy, ecols + max(dx, 0))):
+                coarse = ~fine[row, col]
+                terms.append((numpy.where(coarse, self.blockvalues[row // blocksize, col // blocksize], values[row, col]), numpy.where(coarse, blocksize, 1)))
+            ends.append((self.nodes[erows, ecols + max(-dx, 0)], self.nodes[erows + dy, ecols + max(dx, 0)]))
+            conductances.append(self.conductance(terms[0], terms[1], dy and dx))
+        # Edges of coarse blocks: neighbouring blocks are connected as cells of a coarser grid
+        for dy, dx in offsets:
+            source = (slice(0, brows - dy), slice(max(-dx, 0), bcols - max(dx, 0)))
+            target = (slice(dy, brows), slice(max(dx, 0), bcols + min(dx, 0)))
+            edges = (self.blocknodes[source] >= 0) & (self.blocknodes[target] >= 0)
+            ends.append((self.blocknodes[source][edges], self.blocknodes[target][edges]))
+            conductances.append(self.conductance((self.blockvalues[source][edges], 1), (self.blockvalues[target][edges], 1), dy and dx))
+        del values, valid, fine
+
+        # Parallel edges between the same nodes are merged by adding up their conductances
+        first = numpy.concatenate([numpy.minimum(a, b) for a, b in ends])
+        second = numpy.concatenate([numpy.maximum(a, b) for a, b in ends])
+        keys, inverse = numpy.unique(first * next_id + second, return_inverse=True)
+        self.edges = numpy.column_stack((keys // next_id, keys % next_id, 1 / numpy.bincount(inverse, weights=numpy.concatenate(conductances))))
+        grass.message("Adaptive circuit: " + str(n_nodes) + " nodes and " + str(len(self.edges)) + " edges (" + str(rows * cols) + " cells)")
+
+    def conductance(self, end, end2, diagonal):
+        """ Returns conductances of connections between cells or blocks, as Circuitscape connects raster cells. Ends are (value, length) tuples, where value is resistance or conductance (depending on the connect type) and length is the number of cells from the edge to the centre and back (1 for cells, blocksize for coarse blocks) """
+        (value, length), (value2, length2) = end, end2
+        if self.avgresistance:
+            # Resistances of both halves in series
+            return 1 / ((value * length + value2 * length2) / 2 * (numpy.sqrt(2) if diagonal else 1))
+        # Average conductance weighted by length, over the distance between the centres
+        return (value * length + value2 * length2) / ((length + length2)**2 / 2.0) / (numpy.sqrt(2) if diagonal else 1)
+
+    def write(self, graphfile, focalfile):
+        """ Writes the graph (node, node, resistance on each line) and the focal node list for Circuitscape """
+        numpy.savetxt(graphfile, self.edges, fmt=["%d", "%d", "%.17g"])
+        numpy.savetxt(focalfile, self.focal, fmt="%d")
+
+    def grid(self, filename, current, nullvalue):
+        """ Returns a grid array of node values in a Circuitscape result file (node and value on each line). Current through a coarse block is spread over blocksize cells. Cells of nodes that are not in the file get nullvalue, cells outside the circuit NODATA """
+        results = numpy.loadtxt(filename, ndmin=2)
+        lookup = numpy.full(max(int(self.nodes.max()), int(results[:, 0].max())) + 2, numpy.nan)    # The last one is for cells without node (-1)
+        lookup[results[:, 0].astype(numpy.int64)] = results[:, 1]
+        data = lookup[self.nodes]
+        if current:
+            data[self.nodes >= self.firstcoarse] /= self.blocksize
+        data[numpy.isnan(data)] = nullvalue
+        data[self.nodes < 0] = NODATA
+        return data
+
+
+class ImportPool:
+    """ ImportPool object, runs raster imports as background processes (at most size of them at a time) and deletes imported files when their import has finished """
+    def __init__(self, size):
+        self.size = size
+        self.region = grass.region()    # Computational region, which is also the extent of Circuitscape grids
+        self.running = []               # A list of (process, files to delete) tuples
+
+    def start(self, files, prog, **kwargs):
+        """ Start an import command as soon as there is room in the pool. Files in the list will be deleted after the command has finished """
+        while len(self.running) >= self.size:
+            self.collect(block = True)
+        self.running.append((grass.start_command(prog, **kwargs), files))
+
+    def collect(self, block=False):
+        """ Remove finished imports from the pool and delete their files. If block is True and no import has finished yet, wait for the oldest one """
+        if block and self.running and all(process.poll() is None for process, files in self.running):
+            self.running[0][0].wait()
+        running = []
+        for process, files in self.running:
+            if process.poll() is None:
+                running.append((process, files))
+                continue
+            if process.returncode != 0:
+                print("Error with importing " + ", ".join(files))
+            for file in files:
+                os.remove(file)
+        self.running = running
+
+    def wait(self):
+        """ Wait for all imports to finish """
+        while self.running:
+            self.collect(block = True)
+
+
+class CurrentAccumulator:
+    """ CurrentAccumulator object, sums up pair current maps into cumulative current map and keeps the maximum current map """
+    def __init__(self):
+        self.cumulative = None
+        self.maximum = None
+        self.valid = None   # Cells that have had data in at least one pair map
+
+    def add(self, data):
+        """ Add a pair current map array to the cumulative and maximum current maps """
+        valid = data != NODATA
+        current = numpy.where(valid, data, 0)
+        if self.cumulative is None:
+            self.cumulative = current
+            self.maximum = current.copy()
+            self.valid = valid
+        else:
+            self.cumulative += current
+            numpy.maximum(self.maximum, current, self.maximum)
+            self.valid |= valid
+
+    def result(self):
+        """ Return cumulative and maximum current map arrays with NoData where no pair had any data """
+        if self.cumulative is None:
+            grass.fatal("No current maps were created by Circuitscape")
+        return numpy.where(self.valid, self.cumulative, NODATA), numpy.where(self.valid, self.maximum, NODATA)
+
+
+class ResultWatcher:
+    """ ResultWatcher object, polls the temporary folder for pair or feature maps (or node value files in network mode) Circuitscape has finished writing """
+    def __init__(self, tmppath, prefix, network=False):
+        self.tmppath = tmppath
+        self.prefix = prefix
+        self.handed = set()     # Files that have already been reported as finished
+        # File name parts of current and voltage results and their extensions
+        if network:
+            self.kinds = (("node_currents", "curmap"), ("voltages", "voltmap"))
+            self.extensions = (".txt",)
+        else:
+            self.kinds = (("curmap", "curmap"), ("voltmap", "voltmap"))
+            self.extensions = (".asc", ".npy")
+
+    def ready(self, final=False):
+        """ Returns a list of (kind, key, filename) tuples of finished result maps, where key is a feature pair or a feature and kind is "curmap" or "voltmap". Circuitscape writes the maps one after another, so a map is considered finished when a later map has appeared (it has an older modification time than the newest map), or when Circuitscape has exited (final). The newest maps may still be being written """
+        maps = []
+        for file in sorted(os.listdir(self.tmppath)):
+            for name, kind in self.kinds:
+                start = self.prefix + "_" + name + "_"
+                key = os.path.splitext(file)[0][len(start):]
+                if file.startswith(start) and os.path.splitext(file)[1] in self.extensions and key not in ("cum", "max") and file not in self.handed:
+                    filename = self.tmppath + file
+                    maps.append((os.path.getmtime(filename), kind, key, file, filename))
+        if not maps:
+            return []
+        newest = max(mtime for mtime, kind, key, file, filename in maps)
+        readylist = []
+        for mtime, kind, key, file, filename in maps:
+            if final or mtime < newest:
+                readylist.append((kind, key, filename))
+                self.handed.add(file)
+        return readylist
+
+
+def pairchunks(pairlist, n_chunks):
+    # Method splitting the pair list into n_chunks (at most) consecutive parts of nearly equal size
+    n_chunks = min(n_chunks, len(pairlist))
+    chunks = []
+    for i in range(n_chunks):
+        chunks.append(pairlist[len(pairlist) * i // n_chunks : len(pairlist) * (i + 1) // n_chunks])
+    return chunks
+
+
+def write_pairfile(filename, featlist, pairs):
+    # Method writing a Circuitscape included pairs file: min and max value lines followed by a matrix with focal node ids in the first row and column, where 1 marks pairs to be solved
+    cats = sorted(featlist)
+    index = dict((cat, i) for i, cat in enumerate(cats))
+    matrix = numpy.zeros((len(cats), len(cats)), dtype=int)
+    for pair in pairs:
+        feat, feat2 = [index[int(cat)] for cat in pair.split("_")]
+        matrix[feat, feat2] = matrix[feat2, feat] = 1
+    pairfile = open(filename, "w")
+    pairfile.write("min 1\nmax 1\n")
+    pairfile.write("0 " + " ".join([str(cat) for cat in cats]) + "\n")
+    for i, cat in enumerate(cats):
+        pairfile.write(str(cat) + " " + " ".join([str(value) for value in matrix[i]]) + "\n")
+    pairfile.close()
+
+
+def ini_set(inistring, **settings):
+    # Method returning a copy of Circuitscape .ini file content with the values of given settings replaced
+    lines = inistring.split("\n")
+    for i, line in enumerate(lines):
+        key = line.split(" = ")[0]
+        if key in settings:
+            lines[i] = key + " = " + settings[key]
+    return "\n".join(lines)
+
+
+def merge_resistances(matrices, featlist):
+    # Method merging resistance matrices of several Circuitscape processes (each having solved only a part of pairs) into one. Disconnected or unsolved pairs remain -1
+    cats = sorted(featlist)
+    index = dict((cat, i) for i, cat in enumerate(cats))
+    merged = numpy.zeros((len(cats) + 1, len(cats) + 1))
+    merged[0,1:] = merged[1:,0] = cats
+    merged[1:,1:] = -1
+    numpy.fill_diagonal(merged[1:,1:], 0)
+    for matrix in matrices:
+        ids = [index[int(cat)] + 1 for cat in matrix[0,1:]]
+        for i in range(1, matrix.shape[0]):
+            for j in range(1, matrix.shape[1]):
+                if matrix[i,j] > 0:     # Only pairs that were solved by this process
+                    merged[ids[i-1], ids[j-1]] = matrix[i,j]
+    return merged
+
+
+def write_resistances(matrix, outfile, fmt):
+    # Method writing Circuitscape resistance matrix into CSV or NumPy binary file. The first row and column of the matrix hold the focal node ids (i.e. feature cats) and the rest are effective resistances (-1 for disconnected pairs)
+    if fmt == "npy":
+        # Binary output keeps the same layout: cats in the first row and column, 0 in the upper left corner
+        npy = open(outfile, "wb")   # Passing a file object keeps the file name as given (numpy.save would add .npy)
+        numpy.save(npy, matrix)
+        npy.close()
+        return
+    cats = [str(int(cat)) for cat in matrix[0,1:]]
+    csv = open(outfile, "w")
+    csv.write("cat," + ",".join(cats) + "\n")
+    for i in range(1, matrix.shape[0]):
+        csv.write(str(int(matrix[i,0])) + "," + ",".join([str(value) for value in matrix[i,1:]]) + "\n")
+    csv.close()
+
+
 if __name__ == "__main__":
     options, flags = grass.parser()
     main()
@@ -68,6 +68,14 @@
 #% required: no
 #%end
 
+#%option
+#% key: costout
+#% type: string
+#% gisprompt: new_file,file,output
+#% description: Output binary NumPy file (.npy) of path costs with from_point, to_point and cost columns (needs no vector output)
+#% required: no
+#%end
+
 #%flag
 #% key: c
 #% description: Calculate total cost values for each path and add them to output vector attribute table (very slow)
@@ -80,6 +88,7 @@
 
 import os, sys
 import atexit
+import numpy
 import grass.script as grass
 import grass.lib.vector as vect
 import grass.lib.gis as gis
@@ -99,9 +108,10 @@ def main():
     vectout = options['vectout']                # Vector layer output
     knight = "k" if flags['k'] else ""          # Knight's move flag
     costatt = "e" if flags['c'] else ""         # Calculate total cost values for paths and add them to attribute table
+    costout = options['costout']                # Path cost output file
     
-    # Check no vector or raster output is chosen, raise an error
-    if (not vectout) and (not rastout):
+    # Check no vector, raster or cost output is chosen, raise an error
+    if (not vectout) and (not rastout) and (not costout):
         grass.message("No output chosen!")
         sys.exit()
         
@@ -123,7 +133,7 @@ def main():
         grass.run_command("g.remove", rast = rastout, vect = vectout, quiet = True)
         
     # Get a region resolution to be used in cost attribute calculation, because the default will be in map units
-    if vectout and (costatt == "e"): 
+    if (vectout and (costatt == "e")) or costout:
         # Get raster calculation region information
         regiondata = grass.read_command("g.region", flags = 'p')
         regvalues = grass.parse_key_val(regiondata, sep= ':')
@@ -172,6 +182,8 @@ def main():
     # Create an empty dictionaries for storing cost distances between points
     costdict1 = dict()
     costdict2 = dict()
+    # And a list for (from point, to point, cost) rows of cost output file
+    costlist = list()
     
     # Create the first mapcalc process, so that it can be checked and stopped in the loop without using more complicated ways
     mapcalc = grass.Popen("", shell=True)
@@ -235,33 +247,41 @@ def main():
         costsurf2.wait()
         mapcalc.wait()
         
-        # If vector output is needed, do the r.drain for each point in the drainlist separately to get the cost values
-        if vectout:
-            if costatt == "e":
-                for drainpoint in drainlist1:   # Each point cat in the drainlist is being iterated
-                    drain_x, drain_y = point1.coordsdict[drainpoint]        # Currently selected point's coordinates
-                    drain_onecoord = str(str(drain_x) + "," + str(drain_y)) # The coordinate to be used in r.drain on the next line
-                    grass.run_command('r.drain', overwrite=True, flags="ad", input=costmap1, indir=costdir1, output = lcpmap1, start_coordinates = drain_onecoord)
-                    # Get raster max value (=total cost value for one path) and store it in dictionary with point cat being its key
-                    rastinfo = grass.raster_info(lcpmap1)
-                    costdict1[drainpoint] = rescoefficient * rastinfo['min']
-                    
-                if p2:  # Same procedure as in the previous section for parallel process
-                    for drainpoint in drainlist2:
-                        drain_x, drain_y = point2.coordsdict[drainpoint]
-                        drain_onecoord = str(str(drain_x) + "," + str(drain_y))
-                        grass.run_command('r.drain', overwrite=True, flags="ad", input=costmap2, indir=costdir2, output = lcpmap2, start_coordinates = drain_onecoord)
-                        rastinfo = grass.raster_info(lcpmap2)
-                        costdict2[drainpoint] = rescoefficient * rastinfo['min']
+        # If path costs are needed (for vector attribute table or cost output file), do the r.drain for each point in the drainlist separately to get the cost values
+        if (vectout and costatt == "e") or costout:
+            for drainpoint in drainlist1:   # Each point cat in the drainlist is being iterated
+                drain_x, drain_y = point1.coordsdict[drainpoint]        # Currently selected point's coordinates
+                drain_onecoord = str(str(drain_x) + "," + str(drain_y)) # The coordinate to be used in r.drain on the next line
+                grass.run_command('r.drain', overwrite=True, flags="ad", input=costmap1, indir=costdir1, output = lcpmap1, start_coordinates = drain_onecoord)
+                # Get raster max value (=total cost value for one path) and store it in dictionary with point cat being its key
+                rastinfo = grass.raster_info(lcpmap1)
+                costdict1[drainpoint] = rescoefficient * rastinfo['min']
+                
+            if p2:  # Same procedure as in the previous section for parallel process
+                for drainpoint in drainlist2:
+                    drain_x, drain_y = point2.coordsdict[drainpoint]
+                    drain_onecoord = str(str(drain_x) + "," + str(drain_y))
+                    grass.run_command('r.drain', overwrite=True, flags="ad", input=costmap2, indir=costdir2, output = lcpmap2, start_coordinates = drain_onecoord)
+                    rastinfo = grass.raster_info(lcpmap2)
+                    costdict2[drainpoint] = rescoefficient * rastinfo['min']
             
-            # Finally create the vector layer with all paths from the current point. It also (whether we want it or not) creates a raster output
+            # Add (from point, to point, cost) rows to the cost output list
+            if costout:
+                for drainpoint in drainlist1:
+                    costlist.append((cat1, drainpoint, costdict1[drainpoint]))
+                if p2:
+                    for drainpoint in drainlist2:
+                        costlist.append((cat2, drainpoint, costdict2[drainpoint]))
+        
+        # If vector output is needed, create the vector layer with all paths from the current point. It also (whether we want it or not) creates a raster output
+        if vectout:
             if len(drainlist1) > 0:
                 lcp1 = grass.start_command('r.drain', overwrite=True, flags="d", input=costmap1, indir=costdir1, output = lcpmap1, vector_output = vectdrain1,start_coordinates=drain_coords1)
             if p2 and (len(drainlist2) > 0):
                 lcp2 = grass.start_command('r.drain', overwrite=True, flags="d", input=costmap2, indir=costdir2, output = lcpmap2, vector_output = vectdrain2,start_coordinates=drain_coords2)
         
         # If raster output is needed, but path maps have not been made yet (i.e. vectout must be False) then make those
-        if not vectout and (len(drainlist1) > 0):
+        if rastout and not vectout and (len(drainlist1) > 0):
             lcp1 = grass.start_command('r.drain', overwrite=True, flags="d", input=costmap1, indir=costdir1, output = lcpmap1, start_coordinates=drain_coords1)
             if p2 and (len(drainlist2) > 0):
                 lcp2 = grass.start_command('r.drain', overwrite=True, flags="d", input=costmap2, indir=costdir2, output = lcpmap2, start_coordinates=drain_coords2)
@@ -369,6 +389,10 @@ def main():
         mapcalc.wait()
         nullproc = grass.run_command('r.null', map = rastout, setnull = "0")
 
+    # Write the path costs into a binary file
+    if costout:
+        numpy.save(costout, numpy.array(costlist, dtype=numpy.float64).reshape(-1, 3))
+
     grass.message("All done!")
 
 def cleanup(): # Cleaning service
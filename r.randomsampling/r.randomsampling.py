@@ -53,29 +53,166 @@
 #% answer: 1
 #%end
 
+#%option
+#% key: weights
+#% type: string
+#% gisprompt: old,raster
+#% description: Weight raster. Cells are drawn with replacement, with probability proportional to weight
+#% required: no
+#%end
+
+#%option
+#% key: strata
+#% type: string
+#% gisprompt: old,raster
+#% description: Stratum raster (integer). The sample is divided between strata
+#% required: no
+#%end
+
+#%option
+#% key: allocation
+#% type: string
+#% options: proportional,equal
+#% description: Division of the sample between strata: proportional to stratum size or equal
+#% answer: proportional
+#% required: no
+#%end
+
+#%option
+#% key: format
+#% type: string
+#% options: csv,npy
+#% description: Output file format: CSV table, or binary float32 NumPy matrix (iterations x sample size)
+#% answer: csv
+#% required: no
+#%end
+
+#%option
+#% key: stats
+#% type: string
+#% options: mean,median,stddev,min,max,percentiles,histogram
+#% multiple: yes
+#% description: Write only these summary statistics of each sample instead of sampled values
+#% required: no
+#%end
+
+#%option
+#% key: percentiles
+#% type: double
+#% multiple: yes
+#% description: Percentiles for percentiles statistic
+#% answer: 5,95
+#% required: no
+#%end
+
+#%option
+#% key: bins
+#% type: integer
+#% description: Number of equal width bins between the raster minimum and maximum for histogram statistic
+#% answer: 10
+#% required: no
+#%end
+
+#%option
+#% key: workers
+#% type: integer
+#% description: Number of worker processes for in-memory sampling
+#% answer: 1
+#% required: no
+#%end
+
+#%option
+#% key: seed
+#% type: integer
+#% description: Seed for random number generation (every block of simulations gets its own generator derived from it, so results do not depend on the number of workers). Random if not set
+#% required: no
+#%end
+
+#%flag
+#% key: r
+#% description: Use r.random for sampling (slow, one vector map per iteration)
+#%end
+
 import grass.script as grass
 import grass.lib.vector as vect
 import grass.lib.gis as gis
+from grass.script import array as garray
+import numpy
+import multiprocessing
 import os, sys
 
+BLOCK_VALUES = 1000000      # Number of sampled values drawn and written at a time
+WRITE_BUFFER = 1048576      # Output file buffer size in bytes
+
+samplestate = dict()    # Values, sampler and settings of a sampling process
+
 def main():
     # Input data
     input = options['input']                  # Raster
     size = int(options['size'])                    # Sample size
     nsim = int(options['nsim'])                    # No of simulations
     filepath = options['output']              # Output file path
+    # In stats mode each sample is reduced to summary statistics before writing
+    if options['stats']:
+        info = grass.raster_info(input)
+        summary = SampleSummary(options['stats'].split(","), [float(p) for p in options['percentiles'].split(",")], int(options['bins']), float(info['min']), float(info['max']))
+        columns = summary.columns
+    else:
+        summary = None
+        columns = ["p" + str(n) for n in range(1, size + 1)]
+    writer = SampleWriter(filepath, options['format'], nsim, columns)
     
+    # Sample in memory unless r.random is requested. Simulations are drawn and written in blocks
+    if flags['r'] and (options['weights'] or options['strata']):
+        grass.fatal("Weighted and stratified sampling are not available with r.random")
+    if not flags['r']:
+        workers = int(options['workers'])
+        if workers < 1:
+            grass.fatal("The number of workers must be a positive number")
+        if options['seed']:
+            seed = int(options['seed'])
+        else:
+            seed = numpy.random.RandomState().randint(0, 2**31 - 1)
+            grass.message("Random seed: " + str(seed))
+        values, weights, strata = readvalues(input, options['weights'], options['strata'])
+        sampler = Sampler(size, len(values), weights, strata, options['allocation'])
+        # Values are saved to a temporary file which sampling processes map to memory
+        valuefile = grass.tempfile() + ".npy"
+        numpy.save(valuefile, values)
+        del values
+        # Simulations are drawn in blocks of fixed size, each with its own random generator. A NumPy output matrix is written by the sampling processes at the block offsets; CSV rows are returned and written in order
+        blockrows = max(1, BLOCK_VALUES // size)
+        blocks = [(start, min(blockrows, nsim - start), seed) for start in range(0, nsim, blockrows)]
+        direct = options['format'] == "npy"
+        if direct:
+            writer.close()
+        initargs = (valuefile, sampler, summary, filepath if direct else None)
+        if workers > 1:
+            pool = multiprocessing.Pool(workers, sampleinit, initargs)
+            results = pool.imap(sampleblock, blocks)
+        else:
+            sampleinit(*initargs)
+            results = (sampleblock(block) for block in blocks)
+        try:
+            for start, n_rows, samples in results:
+                if not direct:
+                    writer.write(start, samples)
+                grass.percent(start + n_rows, nsim, 1)
+            if workers > 1:
+                pool.close()
+                pool.join()
+        except KeyboardInterrupt:
+            if workers > 1:
+                pool.terminate()
+                pool.join()
+            grass.fatal("Sampling cancelled")
+        finally:
+            samplestate.clear()
+            os.remove(valuefile)
+        if not direct:
+            writer.close()
+        return
     
-    # Create new csv file
-    csv = open(filepath, "w")
-    classes = ""
-    for n in range(1,size+1):
-        classes = classes + str("p") + str(n)
-        if n != size:
-            classes = classes + ","
-    csv.write(classes)
-    csv.close()
-
     for i in range(0,nsim):
         # Create size * nsim random points
         grass.run_command('r.random', overwrite = True, flags = "b", input=input, n=size, vector_output="tmp_mc")
@@ -84,16 +221,231 @@ def main():
         # Open vector point layer and read values
         content = attributes("tmp_mc", "value")
 
-        # Append data to a csv file
-        csv = open(filepath, "a")
-        csv.write("\n")
-        for item in content:
-            csv.write(str(item))
-            if item != content[len(content)-1]:
-                csv.write(",")
-        csv.close()
+        # Write the sample
+        samples = numpy.array([content])
+        writer.write(i, summary.summarize(samples) if summary else samples)
+    writer.close()
     
     
+def sampleinit(valuefile, sampler, summary, matrixfile):
+    # Method setting up the state of a sampling process: values mapped to memory, sampler, summary (None if values are written) and the NumPy output matrix mapped to memory (None if blocks are returned)
+    samplestate['values'] = numpy.load(valuefile, mmap_mode='r')
+    samplestate['sampler'] = sampler
+    samplestate['summary'] = summary
+    samplestate['matrix'] = numpy.load(matrixfile, mmap_mode='r+') if matrixfile else None
+
+def sampleblock(block):
+    # Method drawing a block of simulations given as a (first simulation, number of simulations, seed) tuple, with a random generator derived from the seed and the first simulation. Returns the first simulation, the number of simulations and the block of samples or summaries (None if written to the output matrix)
+    start, n_rows, seed = block
+    rng = numpy.random.RandomState([seed, start])
+    samples = samplestate['values'][samplestate['sampler'].draw(n_rows, rng)]
+    if samplestate['summary'] is not None:
+        samples = samplestate['summary'].summarize(samples)
+    matrix = samplestate['matrix']
+    if matrix is not None:
+        matrix[start:start + n_rows] = samples
+        matrix.flush()
+        samples = None
+    return start, n_rows, samples
+
+
+class SampleWriter:
+    """ SampleWriter object, writes blocks of simulated samples (or their summaries) through one open file: a CSV table with a header of column names or a float32 NumPy matrix of nsim x columns mapped to memory """
+    def __init__(self, filepath, fmt, nsim, columns):
+        self.fmt = fmt
+        self.row = 0    # Next row of a CSV table
+        if fmt == "npy":
+            self.matrix = numpy.lib.format.open_memmap(filepath, mode="w+", dtype=numpy.float32, shape=(nsim, len(columns)))
+        else:
+            self.csv = open(filepath, "w", WRITE_BUFFER)
+            self.csv.write(",".join(columns))
+
+    def write(self, start, samples):
+        """ Write a block of samples (one sample per row) starting at simulation start. CSV rows must be written in order """
+        if self.fmt == "npy":
+            self.matrix[start:start + len(samples)] = samples
+        else:
+            if start != self.row:
+                grass.fatal("Samples must be written to a CSV file in order")
+            self.csv.write("".join("\n" + ",".join(str(value) for value in sample) for sample in numpy.asarray(samples, dtype=numpy.float64).tolist()))
+            self.row += len(samples)
+
+    def close(self):
+        """ Flush and close the output file """
+        if self.fmt == "npy":
+            self.matrix.flush()
+            del self.matrix
+        else:
+            self.csv.close()
+
+
+class SampleSummary:
+    """ SampleSummary object, reduces blocks of samples to summary statistics. Every sample is in memory, so percentiles are exact """
+    def __init__(self, stats, percentiles, bins, low, high):
+        self.stats = stats
+        self.percentiles = percentiles
+        self.bins = bins
+        self.low = low          # Histogram range: the raster minimum and maximum
+        self.high = high
+        # Column names in statistics order
+        self.columns = []
+        for stat in stats:
+            if stat == "percentiles":
+                self.columns.extend("q%g" % p for p in percentiles)
+            elif stat == "histogram":
+                self.columns.extend("h" + str(n) for n in range(1, bins + 1))
+            else:
+                self.columns.append(stat)
+
+    def summarize(self, samples):
+        """ Returns an array of statistics (one row per sample) of a block of samples (one sample per row) """
+        samples = numpy.asarray(samples, dtype=numpy.float64)
+        results = []
+        for stat in self.stats:
+            if stat == "mean":
+                results.append(samples.mean(axis=1)[:, numpy.newaxis])
+            elif stat == "median":
+                results.append(numpy.median(samples, axis=1)[:, numpy.newaxis])
+            elif stat == "stddev":
+                results.append(samples.std(axis=1)[:, numpy.newaxis])
+            elif stat == "min":
+                results.append(samples.min(axis=1)[:, numpy.newaxis])
+            elif stat == "max":
+                results.append(samples.max(axis=1)[:, numpy.newaxis])
+            elif stat == "percentiles":
+                results.append(numpy.percentile(samples, self.percentiles, axis=1).T)
+            elif stat == "histogram":
+                # Counts of values in equal width bins, the maximum in the last bin. Counts of all samples in a block are found with one bincount
+                width = (self.high - self.low) / self.bins or 1.0
+                binindex = numpy.clip(((samples - self.low) / width).astype(numpy.int64), 0, self.bins - 1)
+                binindex += numpy.arange(len(samples))[:, numpy.newaxis] * self.bins
+                results.append(numpy.bincount(binindex.ravel(), minlength=len(samples) * self.bins).reshape(len(samples), self.bins))
+        return numpy.hstack(results)
+
+
+def readraster(layer):
+    # Method that reads a raster into an array and returns it with a mask of non-null cells. Null cells are read as a value below the raster minimum, so they can not be mistaken for data
+    info = grass.raster_info(layer)
+    if info['min'] is None:
+        grass.fatal("Raster " + layer + " has no non-null cells")
+    nullvalue = float(info['min']) - 1
+    data = garray.array()
+    data.read(layer, null=nullvalue)
+    return data, data != nullvalue
+
+def readvalues(input, weightlayer="", stratalayer=""):
+    # Method that reads the raster once and returns a compact array of its non-null values, and arrays of the weights and strata of the same cells (None if not given). Cells with null or non-positive weight or null stratum are left out
+    data, valid = readraster(input)
+    if weightlayer:
+        weightdata, weightvalid = readraster(weightlayer)
+        valid &= weightvalid & (weightdata > 0)
+    if stratalayer:
+        stratadata, stratavalid = readraster(stratalayer)
+        valid &= stratavalid
+    values = numpy.array(data[valid], dtype=numpy.float64)
+    weights = numpy.array(weightdata[valid], dtype=numpy.float64) if weightlayer else None
+    strata = numpy.array(stratadata[valid], dtype=numpy.int64) if stratalayer else None
+    return values, weights, strata
+
+def drawindices(n_values, size, nsim, rng):
+    # Method that returns an nsim x size array of indices to n_values values, each row a sample without replacement (as r.random does). The cost depends on the sample size, not on n_values
+    if 2 * size > n_values:
+        # Most values are drawn: rank random keys of each row and take the size smallest, in blocks of rows to bound memory use
+        blocksize = max(1, 10**7 // n_values)
+        blocks = []
+        for start in range(0, nsim, blocksize):
+            keys = rng.random_sample((min(blocksize, nsim - start), n_values))
+            rows = numpy.arange(len(keys))[:, numpy.newaxis]
+            chosen = numpy.argpartition(keys, size - 1, axis=1)[:, :size] if size < n_values else numpy.tile(numpy.arange(n_values), (len(keys), 1))
+            blocks.append(chosen[rows, numpy.argsort(keys[rows, chosen], axis=1)])   # In random order
+        return numpy.vstack(blocks).astype(numpy.int64)
+    # Otherwise indices are drawn all at once and only the repeated positions within a row are drawn again (each redraw succeeds with probability of at least 1/2)
+    indices = rng.randint(0, n_values, (nsim, size)).astype(numpy.int64)
+    rows = numpy.arange(nsim)
+    while len(rows):
+        order = numpy.argsort(indices[rows], axis=1, kind='mergesort')
+        ordered = indices[rows[:, numpy.newaxis], order]
+        repeatrow, repeatcol = numpy.nonzero(ordered[:, 1:] == ordered[:, :-1])
+        indices[rows[repeatrow], order[repeatrow, repeatcol + 1]] = rng.randint(0, n_values, len(repeatrow))
+        rows = numpy.unique(rows[repeatrow])
+    return indices
+
+class Sampler:
+    """ Sampler object, draws blocks of samples as indices to values: uniformly without replacement or, if weights are given, with replacement and probability proportional to weight. If strata are given, the sample is divided between strata, with the sample columns in stratum order """
+    def __init__(self, size, n_values, weights=None, strata=None, allocation="proportional"):
+        # Index arrays of the values of each stratum, built once
+        if strata is None:
+            self.groups = [numpy.arange(n_values)]
+            self.sizes = [size]
+        else:
+            order = numpy.argsort(strata, kind='mergesort')
+            ids, starts = numpy.unique(strata[order], return_index=True)
+            self.groups = numpy.split(order, starts[1:])
+            self.sizes = allocate(size, [len(group) for group in self.groups], allocation)
+            grass.message("Sample sizes of strata: " + ", ".join(str(stratum) + ": " + str(n) for stratum, n in zip(ids, self.sizes)))
+        # Alias tables of weighted strata, None for uniform sampling
+        self.tables = [AliasTable(weights[group]) if weights is not None else None for group in self.groups]
+        if weights is None:
+            for group, n in zip(self.groups, self.sizes):
+                if n > len(group):
+                    grass.fatal("Sample size is larger than the number of non-null cells (" + str(len(group)) + ")")
+
+    def draw(self, n_rows, rng):
+        """ Returns an n_rows x size array of value indices """
+        blocks = []
+        for group, n, table in zip(self.groups, self.sizes, self.tables):
+            if n == 0:
+                continue
+            if table is not None:
+                blocks.append(group[table.draw((n_rows, n), rng)])
+            else:
+                blocks.append(group[drawindices(len(group), n, n_rows, rng)])
+        return numpy.hstack(blocks)
+
+
+class AliasTable:
+    """ AliasTable object, draws indices with probability proportional to weights in constant time per draw (Vose's alias method) """
+    def __init__(self, weights):
+        n = len(weights)
+        scaled = numpy.asarray(weights, dtype=numpy.float64) * n / numpy.sum(weights)
+        self.probability = numpy.ones(n)
+        self.alias = numpy.arange(n)
+        small = numpy.nonzero(scaled < 1)[0]
+        large = numpy.nonzero(scaled >= 1)[0]
+        if len(small) == 0:
+            return
+        # Vose's pairing without a Python loop: small entries are topped up in turn from the first large entry until its excess runs out. Then it becomes small itself and is topped up from the next large entry, and so on. With cumulative deficits of the small entries and cumulative excesses of the large entries, each pairing is found with a binary search
+        deficits = numpy.cumsum(1 - scaled[small])
+        excesses = numpy.cumsum(scaled[large] - 1)
+        last = len(large) - 1
+        # Each small entry takes its alias from the large entry in use when its turn comes
+        donor = numpy.minimum(numpy.searchsorted(excesses, numpy.concatenate(([0], deficits[:-1])), side='left'), last)
+        self.probability[small] = scaled[small]
+        self.alias[small] = large[donor]
+        # A large entry runs out at the first small entry whose cumulative deficit exceeds its cumulative excess, and the overshoot is taken from the next large entry. The last one (and those that never run out) are full within rounding error (probability 1)
+        runout = numpy.searchsorted(deficits, excesses[:-1], side='right')
+        depleted = numpy.nonzero(runout < len(small))[0]
+        self.probability[large[depleted]] = 1 - (deficits[runout[depleted]] - excesses[depleted])
+        self.alias[large[depleted]] = large[depleted + 1]
+
+    def draw(self, shape, rng):
+        """ Returns an array of indices of the given shape """
+        indices = rng.randint(0, len(self.alias), shape)
+        return numpy.where(rng.random_sample(shape) < self.probability[indices], indices, self.alias[indices])
+
+
+def allocate(size, counts, allocation):
+    # Method that divides the sample size between strata of given sizes, equally or proportionally to stratum size (largest remainder method). Returns a list of stratum sample sizes
+    if allocation == "equal":
+        quotas = numpy.full(len(counts), float(size) / len(counts))
+    else:
+        quotas = float(size) * numpy.asarray(counts) / numpy.sum(counts)
+    sizes = numpy.floor(quotas).astype(int)
+    # The remaining units go to the strata with the largest remainders
+    for i in numpy.argsort(sizes - quotas, kind='mergesort')[:size - sizes.sum()]:
+        sizes[i] += 1
+    return [int(n) for n in sizes]
+
 def attributes(layer, column):
     # Method that returns attribute data as a list
     temp = grass.tempfile()
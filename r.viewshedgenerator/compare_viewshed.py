@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+############################################################################
+#
+# MODULE:       compare_viewshed.py
+# PURPOSE:      Reproducible accuracy check of the r.viewshedgenerator
+#               built-in viewshed engine
+#
+#       This program is free software under the GNU General Public
+#       License (>=v2). Read the file COPYING that comes with GRASS
+#       for details.
+#
+#############################################################################
+#
+# Run inside a GRASS session:
+#
+#   python compare_viewshed.py [seed=1] [size=120] [observers=5] [min=0.99]
+#   python compare_viewshed.py dem=elevation coordinates=east,north [min=0.99]
+#
+# With a DEM map and observer coordinates, the built-in viewshed is compared
+# with r.viewshed in the current region. This is the accuracy check.
+#
+# Without a DEM, built-in viewsheds of random observers on a synthetic DEM
+# (smoothed noise, generated from the seed) are compared cell by cell with
+# the line of sight tests of the intervisibility mode (lineofsight(), which
+# samples the bilinearly interpolated DEM every half cell). Both are
+# approximations of this module, so this only checks that they are
+# consistent with each other.
+#
+# Prints the share of cells with the same visibility, also among the cells
+# visible in either result (most cells are usually hidden in both), and
+# exits with status 1 if the share of all cells is below min.
+
+import grass.script as grass
+from grass.script import array as garray
+import numpy
+import os, sys
+
+# Load r.viewshedgenerator from the same directory
+path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "r.viewshedgenerator.py")
+try:
+    from importlib.machinery import SourceFileLoader
+    viewshedgenerator = SourceFileLoader("viewshedgenerator", path).load_module()
+except ImportError:
+    import imp
+    viewshedgenerator = imp.load_source("viewshedgenerator", path)
+
+OBS_HEIGHT = 1.75
+TARGET_HEIGHT = 0.0
+
+def syntheticdem(seed, size):
+    # Method returning a reproducible synthetic elevation model: uniform noise smoothed by repeated neighbourhood averaging
+    rng = numpy.random.RandomState(seed)
+    dem = rng.rand(size, size) * 400
+    for i in range(10):
+        padded = numpy.pad(dem, 1, mode="edge")
+        dem = (padded[1:-1, 1:-1] + padded[:-2, 1:-1] + padded[2:, 1:-1] + padded[1:-1, :-2] + padded[1:-1, 2:]) / 5
+    return (dem - dem.mean()) * 3 + 500
+
+def agreement(visible, reference):
+    # Method returning the shares of cells with the same visibility among all cells and among cells visible in either result
+    either = visible | reference
+    return (visible == reference).mean(), (visible == reference)[either].mean() if either.any() else 1.0
+
+def compare_lineofsight(seed, size, n_observers):
+    # Method comparing built-in viewsheds with line of sight tests on a synthetic elevation model. Returns the shares of cells with the same visibility (all cells, cells visible in either)
+    dem = syntheticdem(seed, size)
+    res = 30.0
+    region = {'n': size * res, 'w': 0.0, 'nsres': res, 'ewres': res, 'rows': size, 'cols': size}
+    rng = numpy.random.RandomState(seed)
+    rows, cols = numpy.mgrid[0:size, 0:size]
+    rows = rows.ravel()
+    cols = cols.ravel()
+    visibles = []
+    references = []
+    for i in range(n_observers):
+        row, col = rng.randint(0, size, 2)
+        angles = viewshedgenerator.viewshed(dem, row, col, res, res, OBS_HEIGHT, TARGET_HEIGHT, -1, False)
+        targets = (rows != row) | (cols != col)
+        visible = viewshedgenerator.lineofsight(dem, region, (col + 0.5) * res, region['n'] - (row + 0.5) * res, row, col,
+                                                (cols[targets] + 0.5) * res, region['n'] - (rows[targets] + 0.5) * res, rows[targets], cols[targets],
+                                                OBS_HEIGHT, TARGET_HEIGHT, False)
+        builtin = numpy.isfinite(angles[rows[targets], cols[targets]])
+        print("Observer at row " + str(row) + ", column " + str(col) + ": " + ", ".join(str(share) for share in agreement(builtin, visible)))
+        visibles.append(builtin)
+        references.append(visible)
+    return agreement(numpy.concatenate(visibles), numpy.concatenate(references))
+
+def compare_rviewshed(dem, coordinates):
+    # Method comparing the built-in viewshed with r.viewshed in the current region. Returns the shares of cells with the same visibility (all cells, cells visible in either)
+    region = grass.region()
+    xcoord, ycoord = [float(value) for value in coordinates.split(",")]
+    row = int((region['n'] - ycoord) / region['nsres'])
+    col = int((xcoord - region['w']) / region['ewres'])
+    demdata = viewshedgenerator.readdem(dem)
+    angles = viewshedgenerator.viewshed(demdata, row, col, region['nsres'], region['ewres'], OBS_HEIGHT, TARGET_HEIGHT, -1, False)
+    tmpmap = "tmp_compare_viewshed_" + str(os.getpid())
+    grass.run_command('r.viewshed', overwrite = True, quiet = True, input = dem, output = tmpmap, coordinates = coordinates, obs_elev = OBS_HEIGHT, tgt_elev = TARGET_HEIGHT)
+    reference = garray.array()
+    reference.read(tmpmap, null = -1)   # Vertical angles are never negative
+    grass.run_command('g.remove', rast = tmpmap, quiet = True)
+    valid = numpy.isfinite(demdata)
+    valid[row, col] = False     # The observer cell itself
+    return agreement(numpy.isfinite(angles)[valid], (reference >= 0)[valid])
+
+def main():
+    args = dict(arg.split("=", 1) for arg in sys.argv[1:])
+    minimum = float(args.get('min', 0.99))
+    if 'dem' in args:
+        shares = compare_rviewshed(args['dem'], args['coordinates'])
+    else:
+        shares = compare_lineofsight(int(args.get('seed', 1)), int(args.get('size', 120)), int(args.get('observers', 5)))
+    print("Agreement: " + str(shares[0]) + " (cells visible in either: " + str(shares[1]) + ")")
+    sys.exit(0 if shares[0] >= minimum else 1)
+
+if __name__ == "__main__":
+    main()
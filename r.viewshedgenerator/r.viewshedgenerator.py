@@ -73,20 +73,117 @@
 #% required:no
 #%end
 
+#%option
+#% key: workers
+#% type: integer
+#% description: Number of viewsheds generated in parallel
+#% answer: 1
+#% required: no
+#%end
+
+#%option
+#% key: cumulative
+#% type: string
+#% gisprompt: new,cell,raster
+#% description: Cumulative viewshed output (number of observers that see each cell). Single viewsheds are then written only with -k flag
+#% required: no
+#%end
+
+#%flag
+#% key: k
+#% description: Keep single viewsheds when cumulative output is given
+#%end
+
+#%option
+#% key: engine
+#% type: string
+#% options: r.viewshed,builtin
+#% description: Viewshed engine: r.viewshed module, or built-in engine with the elevation model read into memory once
+#% answer: r.viewshed
+#% required: no
+#%end
+
+#%option
+#% key: obs_heights
+#% type: double
+#% multiple: yes
+#% description: List of observer's heights for multi-height mode (built-in engine). Single outputs are minimum visible target height maps for each observer's height
+#% required: no
+#%end
+
+#%option
+#% key: target_heights
+#% type: double
+#% multiple: yes
+#% description: List of target heights for multi-height mode. Cumulative outputs are generated for each observer's and target height combination
+#% required: no
+#%end
+
+#%option
+#% key: cache
+#% type: string
+#% description: Directory of the viewshed cache (built-in engine). Viewsheds of observers already in the cache with the same elevation model, region and settings are not recomputed
+#% required: no
+#%end
+
+#%option
+#% key: cachesize
+#% type: double
+#% description: Maximum size of the viewshed cache in megabytes. Least recently used viewsheds are removed when it is exceeded
+#% answer: 1024
+#% required: no
+#%end
+
+#%option
+#% key: intervisibility
+#% type: string
+#% description: Intervisibility output: vector lines map or CSV file of point pairs where the target point is visible from the observer point. No viewsheds are generated
+#% required: no
+#%end
+
+#%option
+#% key: visformat
+#% type: string
+#% options: vector,csv
+#% description: Intervisibility output format
+#% answer: vector
+#% required: no
+#%end
+
 import grass.script as grass
 import grass.lib.vector as vect
 import grass.lib.gis as gis
-import os, sys
+from grass.script import array as garray
+import numpy
+import math
+import hashlib
+import multiprocessing
+import os, sys, time
+
+POLL_INTERVAL = 0.1     # Seconds between checks for finished worker processes
+NODATA = -9999      # Null value of raw binary tiles
+SAMPLE_LIMIT = 4000000  # Maximum number of elevation samples tested at once in intervisibility mode
+CACHE_VERSION = 1   # Version of the built-in engine results in the cache; increase when the results change
+CACHE_EVICT_INTERVAL = 20   # Number of viewsheds between cache size checks during a run
+EARTH_RADIUS = 6378137.0    # Earth radius for curvature correction (WGS84 semi-major axis)
+LOW = -1e300    # Horizon of the observer cell; finite, so that horizons can be interpolated
+
+viewstate = dict()  # Settings and elevation model of a built-in engine worker process
 
 def main():
     # Input data
     points = options['points']                  # Point layer
     dem = options['dem']                        # Elevation model
-    curvature = "c" if flags['c'] else ""       # Earth's curvature flag
-    obs_height = options['obs_height']          # Observer's height
-    target_height = options['target_height']    # Target height offset
-    maxradius = options['maxradius']            # Max radius
+    maxradius = float(options['maxradius'])     # Max radius
     output_prefix = options['prefix']           # Output layer prefix
+    workers = int(options['workers'])           # Number of parallel r.viewshed processes
+    if workers < 1:
+        grass.fatal("The number of workers must be a positive number")
+    cumulative = options['cumulative']          # Cumulative viewshed output
+    keep = flags['k'] or not cumulative         # Write single viewsheds
+    engine = options['engine']                  # Viewshed engine
+    if options['cache'] and engine != "builtin":
+        grass.warning("The viewshed cache is used only with the built-in engine")
     
     # Get individual point coordinates and write them to dictionary
     # Create a new Map_info() object
@@ -115,15 +212,537 @@ def main():
     vect.Vect_destroy_cats_struct(cats)
     vect.Vect_close(map)
     
-    # Do the loop
-    for pointnumber in range(1,n_lines + 1):
-        # Get x and y coordinates from dictionary created earlier and merge them into one string
+    # Get observer cells and their windows. Each observer is processed only in a window reaching maxradius around it (the whole region if the radius is infinite)
+    region = grass.region()
+    observers = []
+    for pointnumber in sorted(coordsdict.keys()):
         xcoord, ycoord = coordsdict[pointnumber]
-        point_coords = str(str(xcoord) + "," + str(ycoord))
-        # Generate output raster name
-        outraster = str(str(output_prefix) + str(pointnumber))
-        # Run r.viewshed
-        grass.run_command('r.viewshed', flags = curvature, overwrite = True, input = dem, output = outraster, coordinates = point_coords, obs_elev = obs_height, tgt_elev = target_height, max_dist = maxradius)
+        row = int(math.floor((region['n'] - ycoord) / region['nsres']))
+        col = int(math.floor((xcoord - region['w']) / region['ewres']))
+        if not (0 <= row < region['rows'] and 0 <= col < region['cols']):
+            grass.warning("Point " + str(pointnumber) + " is outside the current region, skipped")
+            continue
+        observers.append((pointnumber, row, col, observerwindow(region, row, col, maxradius)))
+    
+    # In intervisibility mode only lines of sight between the points are tested
+    if options['intervisibility']:
+        if cumulative:
+            grass.warning("No cumulative viewshed is generated in intervisibility mode")
+        intervisibility(dem, observers, coordsdict, region, options['intervisibility'], options['visformat'])
+        return
+    
+    # In multi-height mode visibility for all observer's and target height combinations is derived from one horizon pass per observer
+    if options['obs_heights'] or options['target_heights']:
+        if engine != "builtin":
+            grass.fatal("Multi-height mode requires the built-in engine")
+        obs_heights = [float(height) for height in (options['obs_heights'] or options['obs_height']).split(",")]
+        target_heights = [float(height) for height in (options['target_heights'] or options['target_height']).split(",")]
+        # Cumulative viewsheds of all combinations are counted in one array (observer's height, target height, row, column)
+        counter = numpy.zeros((len(obs_heights), len(target_heights), region['rows'], region['cols']), dtype=numpy.int32) if cumulative else None
+        builtinviewsheds(dem, observers, region, workers, output_prefix, keep, counter, obs_heights, target_heights)
+        if cumulative:
+            output = garray.array(dtype=numpy.int32)
+            for i in range(len(obs_heights)):
+                for j in range(len(target_heights)):
+                    output[...] = counter[i, j]
+                    output.write(cumulative + "_o" + str(i + 1) + "_t" + str(j + 1), overwrite = grass.overwrite())
+        return
+    
+    # Cumulative viewshed is counted in memory: every viewshed is added to the counter as soon as it is finished and removed if it is not kept
+    if cumulative:
+        counter = garray.array(dtype=numpy.int32)
+        counter[...] = 0
+    
+    # Generate viewsheds with the chosen engine
+    if engine == "builtin":
+        builtinviewsheds(dem, observers, region, workers, output_prefix, keep, counter if cumulative else None)
+    else:
+        moduleviewsheds(dem, observers, coordsdict, region, workers, output_prefix, keep, counter if cumulative else None)
+    
+    # Write cumulative viewshed
+    if cumulative:
+        counter.write(cumulative, overwrite = grass.overwrite())
+
+
+def observerwindow(region, row, col, maxradius):
+    # Method returning the window of cells within maxradius of the observer cell as a (first row, end row, first column, end column) tuple, clipped to the region
+    if maxradius < 0:
+        return (0, region['rows'], 0, region['cols'])
+    rowradius = int(math.ceil(maxradius / region['nsres']))
+    colradius = int(math.ceil(maxradius / region['ewres']))
+    return (max(row - rowradius, 0), min(row + rowradius + 1, region['rows']), max(col - colradius, 0), min(col + colradius + 1, region['cols']))
+
+def windowregion(region, window):
+    # Method returning the bounds and size of a window as a dictionary of region settings
+    row0, row1, col0, col1 = window
+    return {'n': region['n'] - row0 * region['nsres'], 's': region['n'] - row1 * region['nsres'],
+            'w': region['w'] + col0 * region['ewres'], 'e': region['w'] + col1 * region['ewres'],
+            'rows': row1 - row0, 'cols': col1 - col0}
+
+def windowenv(region, window):
+    # Method returning a copy of the environment where the computational region (GRASS_REGION) is set to the window
+    bounds = windowregion(region, window)
+    env = os.environ.copy()
+    env['GRASS_REGION'] = grass.region_env(n = bounds['n'], s = bounds['s'], e = bounds['e'], w = bounds['w'], nsres = region['nsres'], ewres = region['ewres'])
+    return env
+
+def readdem(dem):
+    # Method reading the elevation model of the region into an array, nan for null cells. Null cells are read as a value below the minimum elevation, so they can not be mistaken for data
+    info = grass.raster_info(dem)
+    if info['min'] is None:
+        grass.fatal("Elevation model " + dem + " has no non-null cells")
+    nullvalue = float(info['min']) - 1
+    demdata = garray.array()
+    demdata.read(dem, null = nullvalue)
+    demdata[demdata == nullvalue] = numpy.nan
+    return demdata
+
+def read_tile(raster, region, window, rawfile):
+    # Method reading a raster map in a window into an array (nan for null cells) through a raw binary file
+    bounds = windowregion(region, window)
+    grass.run_command('r.out.bin', flags = "f", input = raster, output = rawfile, bytes = 8, null = NODATA, quiet = True, env = windowenv(region, window))
+    data = numpy.fromfile(rawfile, dtype = numpy.float64).reshape(bounds['rows'], bounds['cols'])
+    os.remove(rawfile)
+    data[data == NODATA] = numpy.nan
+    return data
+
+def write_tile(data, raster, region, window, rawfile):
+    # Method writing an array (nan for null cells) into a raster map covering the window through a raw binary file
+    bounds = windowregion(region, window)
+    numpy.where(numpy.isnan(data), NODATA, data).astype(numpy.float64).tofile(rawfile)
+    grass.run_command('r.in.bin', flags = "d", overwrite = True, input = rawfile, output = raster, anull = NODATA, quiet = True,
+                      north = bounds['n'], south = bounds['s'], east = bounds['e'], west = bounds['w'], rows = bounds['rows'], cols = bounds['cols'])
+    os.remove(rawfile)
+
+
+def intervisibility(dem, observers, coordsdict, region, output, visformat):
+    # Method finding the directed pairs of points where the target point is visible from the observer point, and writing them to a vector lines map or a CSV file
+    if grass.locn_is_latlong():
+        grass.fatal("Intervisibility is not supported in latitude-longitude locations")
+    demdata = readdem(dem)
+    maxradius = float(options['maxradius'])
+    obs_height = float(options['obs_height'])
+    target_height = float(options['target_height'])
+    # Points on null cells can neither see nor be seen
+    points = [(pointnumber, row, col) for pointnumber, row, col, window in observers if not numpy.isnan(demdata[row, col])]
+    cats = numpy.array([pointnumber for pointnumber, row, col in points])
+    xs = numpy.array([coordsdict[pointnumber][0] for pointnumber, row, col in points])
+    ys = numpy.array([coordsdict[pointnumber][1] for pointnumber, row, col in points])
+    rows = numpy.array([row for pointnumber, row, col in points], dtype=int)
+    cols = numpy.array([col for pointnumber, row, col in points], dtype=int)
+    
+    # Spatial index: points are put in square buckets of maxradius size, so the targets within maxradius of an observer are in the 3 x 3 buckets around it
+    if maxradius >= 0:
+        bucketsize = max(maxradius, region['nsres'], region['ewres'])
+        buckets = dict()
+        for i in range(len(points)):
+            buckets.setdefault((int(math.floor(xs[i] / bucketsize)), int(math.floor(ys[i] / bucketsize))), []).append(i)
+    
+    pairs = []
+    for i in range(len(points)):
+        grass.percent(i, len(points), 1)
+        # Candidate targets
+        if maxradius >= 0:
+            bx = int(math.floor(xs[i] / bucketsize))
+            by = int(math.floor(ys[i] / bucketsize))
+            targets = numpy.array(sum((buckets.get((bx + dx, by + dy), []) for dx in (-1, 0, 1) for dy in (-1, 0, 1)), []), dtype=int)
+        else:
+            targets = numpy.arange(len(points))
+        distance = numpy.hypot(xs[targets] - xs[i], ys[targets] - ys[i])
+        near = (distance > 0) & ((distance <= maxradius) | (maxradius < 0))
+        targets = targets[near]
+        distance = distance[near]
+        if len(targets) == 0:
+            continue
+        # Test lines of sight in chunks that keep the sample arrays small
+        n_samples = 2 * int(math.ceil(distance.max() / min(region['nsres'], region['ewres']))) + 2
+        chunksize = max(1, SAMPLE_LIMIT // n_samples)
+        for start in range(0, len(targets), chunksize):
+            chunk = targets[start:start + chunksize]
+            visible = lineofsight(demdata, region, xs[i], ys[i], rows[i], cols[i], xs[chunk], ys[chunk], rows[chunk], cols[chunk], obs_height, target_height, flags['c'])
+            for j, d in zip(chunk[visible], distance[start:start + chunksize][visible]):
+                pairs.append((cats[i], cats[j], d))
+    grass.percent(1, 1, 1)
+    grass.message(str(len(pairs)) + " intervisible point pairs found")
+    
+    # Write the pairs
+    if visformat == "csv":
+        outfile = open(output, "w")
+        outfile.write("from_point,to_point,distance\n")
+        for fromcat, tocat, d in pairs:
+            outfile.write(str(fromcat) + "," + str(tocat) + "," + str(d) + "\n")
+        outfile.close()
+    else:
+        # Lines are imported in standard vector ASCII format, line number as category, and the attributes are filled in with one db.execute call
+        lines = []
+        sql = []
+        for linecat, (fromcat, tocat, d) in enumerate(pairs, 1):
+            x0, y0 = coordsdict[fromcat]
+            x1, y1 = coordsdict[tocat]
+            lines.append("L 2 1\n " + repr(x0) + " " + repr(y0) + "\n " + repr(x1) + " " + repr(y1) + "\n 1 " + str(linecat))
+            sql.append("UPDATE " + output + " SET from_point = " + str(fromcat) + ", to_point = " + str(tocat) + ", distance = " + str(d) + " WHERE cat = " + str(linecat) + ";")
+        grass.write_command('v.in.ascii', flags = "n", input = "-", output = output, format = "standard", overwrite = grass.overwrite(), quiet = True, stdin = "\n".join(lines) + "\n")
+        grass.run_command('v.db.addtable', map = output, columns = "from_point integer, to_point integer, distance double precision", quiet = True)
+        if sql:
+            grass.write_command('db.execute', input = "-", stdin = "\n".join(sql) + "\n")
+
+def lineofsight(demdata, region, x0, y0, row0, col0, xs, ys, rows, cols, obs_height, target_height, curvature):
+    # Method testing the lines of sight from the observer at (x0, y0) in cell (row0, col0) to arrays of target points and their cells. The elevation model is sampled (bilinear interpolation between cell centres) at half cell intervals between the observer and target cells. Returns a boolean array, True if the target is visible
+    distance = numpy.hypot(xs - x0, ys - y0)
+    n_samples = 2 * int(math.ceil(distance.max() / min(region['nsres'], region['ewres']))) + 2
+    # Sample positions as fractions of the line length, end points excluded
+    t = numpy.arange(1, n_samples) / float(n_samples)
+    samplex = x0 + numpy.outer(xs - x0, t)
+    sampley = y0 + numpy.outer(ys - y0, t)
+    samplerows = numpy.clip(numpy.floor((region['n'] - sampley) / region['nsres']).astype(int), 0, region['rows'] - 1)
+    samplecols = numpy.clip(numpy.floor((samplex - region['w']) / region['ewres']).astype(int), 0, region['cols'] - 1)
+    sampledistance = numpy.outer(distance, t)
+    # Fractional positions from the centre of the upper left cell
+    fracrows = numpy.clip((region['n'] - sampley) / region['nsres'] - 0.5, 0, region['rows'] - 1)
+    fraccols = numpy.clip((samplex - region['w']) / region['ewres'] - 0.5, 0, region['cols'] - 1)
+    toprows = numpy.minimum(fracrows.astype(int), max(region['rows'] - 2, 0))
+    leftcols = numpy.minimum(fraccols.astype(int), max(region['cols'] - 2, 0))
+    rowweight = fracrows - toprows
+    colweight = fraccols - leftcols
+    bottomrows = numpy.minimum(toprows + 1, region['rows'] - 1)
+    rightcols = numpy.minimum(leftcols + 1, region['cols'] - 1)
+    elevation = ((1 - rowweight) * ((1 - colweight) * demdata[toprows, leftcols] + colweight * demdata[toprows, rightcols]) +
+                 rowweight * ((1 - colweight) * demdata[bottomrows, leftcols] + colweight * demdata[bottomrows, rightcols]))
+    targetelevation = demdata[rows, cols] + target_height
+    if curvature:
+        elevation = elevation - sampledistance ** 2 / (2 * EARTH_RADIUS)
+        targetelevation = targetelevation - distance ** 2 / (2 * EARTH_RADIUS)
+    eye = demdata[row0, col0] + obs_height
+    gradient = (elevation - eye) / sampledistance
+    # Samples in the observer or target cell and null cells do not block the view
+    ownrow = rows[:, numpy.newaxis]
+    owncol = cols[:, numpy.newaxis]
+    gradient[((samplerows == row0) & (samplecols == col0)) | ((samplerows == ownrow) & (samplecols == owncol)) | numpy.isnan(gradient)] = -numpy.inf
+    return (targetelevation - eye) / distance >= gradient.max(axis=1)
+
+
+def moduleviewsheds(dem, observers, coordsdict, region, workers, output_prefix, keep, counter):
+    # Method generating viewsheds with r.viewshed, each run in the window of its observer. Viewsheds are added to the counter if it is given
+    curvature = "c" if flags['c'] else ""
+    windows = dict((pointnumber, window) for pointnumber, row, col, window in observers)
+    rawfile = grass.tempfile()
+    # Do the loop. Viewsheds are run in a pool of worker processes; if the module is interrupted, all workers are stopped and their unfinished outputs removed
+    pool = ViewshedPool(workers, len(observers))
+    try:
+        for pointnumber, row, col, window in observers:
+            # Get x and y coordinates from dictionary created earlier and merge them into one string
+            xcoord, ycoord = coordsdict[pointnumber]
+            point_coords = str(str(xcoord) + "," + str(ycoord))
+            # Generate output raster name; temporary if single viewsheds are not kept
+            if keep:
+                outraster = str(str(output_prefix) + str(pointnumber))
+            else:
+                outraster = "tmp_viewshed_" + str(os.getpid()) + "_" + str(pointnumber)
+            # Run r.viewshed as soon as a worker is free
+            finished = pool.start(pointnumber, outraster, flags = curvature, overwrite = True, quiet = True, input = dem, output = outraster, coordinates = point_coords, obs_elev = options['obs_height'], tgt_elev = options['target_height'], max_dist = options['maxradius'], env = windowenv(region, window))
+            if counter is not None:
+                accumulate(counter, finished, keep, region, windows, rawfile)
+        finished = pool.wait()
+        if counter is not None:
+            accumulate(counter, finished, keep, region, windows, rawfile)
+    except KeyboardInterrupt:
+        pool.cancel()
+        grass.fatal("Viewshed generation cancelled")
+    except BaseException:
+        # Also on errors (including a failed r.viewshed) all workers are stopped before exiting
+        pool.cancel()
+        raise
+
+def accumulate(counter, finished, keep, region, windows, rawfile):
+    # Method adding finished viewsheds (list of (point number, raster) tuples) to the counter at the offsets of their windows. Rasters are removed if they are not kept
+    for pointnumber, raster in finished:
+        row0, row1, col0, col1 = windows[pointnumber]
+        # Invisible cells are null
+        counter[row0:row1, col0:col1] += numpy.isfinite(read_tile(raster, region, windows[pointnumber], rawfile))
+        if not keep:
+            grass.run_command('g.remove', rast = raster, quiet = True)
+
+
+def builtinviewsheds(dem, observers, region, workers, output_prefix, keep, counter, obs_heights=None, target_heights=None):
+    # Method generating viewsheds with the built-in engine. The elevation model is read once and saved to a temporary file, which worker processes map to memory read-only. Viewsheds are added to the counter if it is given. If lists of observer's and target heights are given, minimum visible target heights are computed for each observer's height instead, and the counter has a layer for each height combination
+    if grass.locn_is_latlong():
+        grass.fatal("The built-in engine does not support latitude-longitude locations")
+    demdata = readdem(dem)
+    # Skip observers on null cells
+    for observer in list(observers):
+        pointnumber, row, col, window = observer
+        if numpy.isnan(demdata[row, col]):
+            grass.warning("Point " + str(pointnumber) + " is on a null cell, skipped")
+            observers.remove(observer)
+    # Cache keys are derived from the elevation model content, the region and the settings, and the observer cell and window
+    cachedir = options['cache']
+    cachebase = None
+    if cachedir:
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        settings = (CACHE_VERSION, hashlib.sha1(numpy.ascontiguousarray(demdata)).hexdigest(), region['n'], region['s'], region['e'], region['w'], region['nsres'], region['ewres'],
+                    float(options['obs_height']), float(options['target_height']), obs_heights, float(options['maxradius']), flags['c'])
+        cachebase = hashlib.sha1(repr(settings).encode()).hexdigest()
+    demfile = grass.tempfile() + ".npy"
+    numpy.save(demfile, demdata)
+    del demdata
+    rawfile = grass.tempfile()
+    
+    # Viewsheds are computed in worker processes (or in this process if there is only one worker) and written as they come in
+    initargs = (demfile, region['nsres'], region['ewres'], float(options['obs_height']), float(options['target_height']), float(options['maxradius']), flags['c'], obs_heights, cachedir, cachebase)
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, viewinit, initargs)
+        results = pool.imap_unordered(computeviewshed, observers)
+    else:
+        viewinit(*initargs)
+        results = (computeviewshed(observer) for observer in observers)
+    try:
+        n_done = 0
+        for pointnumber, window, result, pid in results:
+            n_done += 1
+            grass.verbose("Worker " + str(pid) + ": viewshed of point " + str(pointnumber) + " done")
+            grass.percent(n_done, len(observers), 1)
+            # Keep the cache within its size as viewsheds are stored, not only at the end of the run
+            if cachedir and n_done % CACHE_EVICT_INTERVAL == 0:
+                cacheevict(cachedir, float(options['cachesize']) * 1024 * 1024)
+            row0, row1, col0, col1 = window
+            if obs_heights is None:
+                # Result is an array of vertical angles
+                if counter is not None:
+                    counter[row0:row1, col0:col1] += numpy.isfinite(result)
+                if keep:
+                    write_tile(result, output_prefix + str(pointnumber), region, window, rawfile)
+            else:
+                # Result is an array of minimum visible target heights for each observer's height
+                if counter is not None:
+                    with numpy.errstate(invalid = 'ignore'):
+                        for j, target_height in enumerate(target_heights):
+                            counter[:, j, row0:row1, col0:col1] += result <= target_height
+                if keep:
+                    for i in range(len(obs_heights)):
+                        write_tile(result[i], output_prefix + str(pointnumber) + "_o" + str(i + 1), region, window, rawfile)
+        if workers > 1:
+            pool.close()
+            pool.join()
+    except KeyboardInterrupt:
+        if workers > 1:
+            pool.terminate()
+            pool.join()
+        grass.fatal("Viewshed generation cancelled")
+    finally:
+        viewstate.clear()
+        os.remove(demfile)
+        if cachedir:
+            cacheevict(cachedir, float(options['cachesize']) * 1024 * 1024)
+
+
+def viewinit(demfile, nsres, ewres, obs_height, target_height, maxradius, curvature, obs_heights, cachedir, cachebase):
+    # Method setting up the state of a built-in engine worker process: settings and the elevation model mapped to memory
+    viewstate['dem'] = numpy.load(demfile, mmap_mode = 'r')
+    viewstate['nsres'] = nsres
+    viewstate['ewres'] = ewres
+    viewstate['obs_height'] = obs_height
+    viewstate['target_height'] = target_height
+    viewstate['maxradius'] = maxradius
+    viewstate['curvature'] = curvature
+    viewstate['obs_heights'] = obs_heights     # List of observer's heights in multi-height mode, None otherwise
+    viewstate['cachedir'] = cachedir    # Cache directory, empty if the cache is not used
+    viewstate['cachebase'] = cachebase  # Cache key part common to all observers
+
+def computeviewshed(observer):
+    # Method computing the viewshed of the observer given as a (point number, row, column, window) tuple in its window. Returns the point number, the window, the array of vertical angles (or of minimum visible target heights for each observer's height in multi-height mode) in the window and the process id
+    pointnumber, row, col, window = observer
+    row0, row1, col0, col1 = window
+    # Serve the viewshed from the cache if it is there, marking it as recently used
+    if viewstate['cachedir']:
+        cachefile = os.path.join(viewstate['cachedir'], hashlib.sha1((viewstate['cachebase'] + repr((row, col, window))).encode()).hexdigest() + ".npz")
+        if os.path.exists(cachefile):
+            try:
+                cached = numpy.load(cachefile)
+                result = cached['result']
+                cached.close()
+                os.utime(cachefile, None)
+                return pointnumber, window, result, os.getpid()
+            except (IOError, OSError, ValueError, KeyError):
+                pass    # Unreadable or removed by another process; compute again
+    dem = viewstate['dem'][row0:row1, col0:col1]
+    if viewstate['obs_heights'] is None:
+        result = viewshed(dem, row - row0, col - col0, viewstate['nsres'], viewstate['ewres'], viewstate['obs_height'], viewstate['target_height'], viewstate['maxradius'], viewstate['curvature'])
+    else:
+        result = mintargetheights(dem, row - row0, col - col0, viewstate['nsres'], viewstate['ewres'], viewstate['obs_heights'], viewstate['maxradius'], viewstate['curvature'])
+    # Store the viewshed in the cache. It is written to a temporary file first, so that other processes never read a partial file
+    if viewstate['cachedir']:
+        result = result.astype(numpy.float32)   # Same precision as served from the cache
+        tmpfile = cachefile + "." + str(os.getpid()) + ".tmp.npz"
+        numpy.savez_compressed(tmpfile, result = result)
+        try:
+            os.rename(tmpfile, cachefile)
+        except OSError:
+            os.remove(tmpfile)
+    return pointnumber, window, result, os.getpid()
+
+def cacheevict(cachedir, maxsize):
+    # Method removing least recently used (oldest modification time) viewsheds from the cache until its size is at most maxsize bytes. Worker processes (or other runs) may add and remove files at the same time, so files that have disappeared are skipped
+    entries = []
+    for file in os.listdir(cachedir):
+        if file.endswith(".npz") and not file.endswith(".tmp.npz"):
+            filename = os.path.join(cachedir, file)
+            try:
+                entries.append((os.path.getmtime(filename), os.path.getsize(filename), filename))
+            except OSError:
+                pass
+    total = sum(size for mtime, size, filename in entries)
+    for mtime, size, filename in sorted(entries):
+        if total <= maxsize:
+            break
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        total -= size
+
+
+def horizons(dem, row, col, nsres, ewres, obs_heights, maxradius, curvature):
+    # Method computing the horizons of all cells seen from the observer at cell (row, col) of the elevation array dem (nan for null cells), for each observer height in one pass. The horizon of a cell is the greatest elevation gradient (from the observer's eye) of the cells before it on the line of sight. Returns an array of horizons (observer height, row, column), nan for cells beyond maxradius
+    n_rows, n_cols = dem.shape
+    eyes = dem[row, col] + numpy.asarray(obs_heights, dtype=float)[:, numpy.newaxis]
+    # Block of each processed cell: the greatest gradient of the cells on the line of sight up to and including the cell
+    block = numpy.empty((len(obs_heights),) + dem.shape)
+    block[:, row, col] = LOW
+    horizon = numpy.full(block.shape, numpy.nan)
+    horizon[:, row, col] = LOW
+    # Rings of cells at increasing distance (in cells) from the observer are processed one at a time. The horizon of a cell is interpolated from the blocks of the two cells of the previous ring between which the line of sight passes (Xdraw)
+    n_rings = max(row, col, n_rows - 1 - row, n_cols - 1 - col)
+    if maxradius >= 0:
+        n_rings = min(n_rings, int(math.ceil(maxradius / min(nsres, ewres))))
+    for k in range(1, n_rings + 1):
+        # Cell offsets of the ring: top and bottom rows are row-dominant, left and right columns (without corners) column-dominant
+        span = numpy.arange(-k, k + 1)
+        side = numpy.arange(-k + 1, k)
+        dr = numpy.concatenate((numpy.full(2 * k + 1, -k), numpy.full(2 * k + 1, k), side, side))
+        dc = numpy.concatenate((span, span, numpy.full(2 * k - 1, -k), numpy.full(2 * k - 1, k)))
+        rowdominant = numpy.abs(dr) == k
+        # Keep cells inside the array
+        inside = (row + dr >= 0) & (row + dr < n_rows) & (col + dc >= 0) & (col + dc < n_cols)
+        dr, dc, rowdominant = dr[inside], dc[inside], rowdominant[inside]
+        if len(dr) == 0:
+            break
+        # Position of the line of sight on the previous ring, along the ring side
+        major = numpy.where(rowdominant, dr, dc)
+        minor = numpy.where(rowdominant, dc, dr)
+        position = minor * (k - 1) / float(k)
+        low = numpy.floor(position).astype(int)
+        high = numpy.ceil(position).astype(int)
+        weight = position - low
+        prevmajor = major - numpy.sign(major)
+        r0 = row + numpy.where(rowdominant, prevmajor, low)
+        c0 = col + numpy.where(rowdominant, low, prevmajor)
+        r1 = row + numpy.where(rowdominant, prevmajor, high)
+        c1 = col + numpy.where(rowdominant, high, prevmajor)
+        b0 = block[:, r0, c0]
+        b1 = block[:, r1, c1]
+        cellhorizon = b0 + weight * (b1 - b0)
+        # Elevation gradient of the ring cells from the observer's eye
+        rows = row + dr
+        cols = col + dc
+        distance = numpy.hypot(dr * nsres, dc * ewres)
+        elevation = dem[rows, cols]
+        if curvature:
+            elevation = elevation - distance ** 2 / (2 * EARTH_RADIUS)
+        gradient = (elevation - eyes) / distance
+        # Null cells do not block the view
+        gradient = numpy.where(numpy.isnan(gradient), LOW, gradient)
+        horizon[:, rows, cols] = cellhorizon
+        block[:, rows, cols] = numpy.maximum(cellhorizon, gradient)
+    return horizon
+
+def cellgeometry(dem, row, col, nsres, ewres, maxradius, curvature):
+    # Method returning arrays of the distance of each cell from the observer cell and of cell elevations corrected for curvature. Cells beyond maxradius get null elevation
+    n_rows, n_cols = dem.shape
+    dr, dc = numpy.mgrid[-row:n_rows - row, -col:n_cols - col]
+    distance = numpy.hypot(dr * nsres, dc * ewres)
+    elevation = numpy.array(dem, dtype=float)
+    if curvature:
+        elevation -= distance ** 2 / (2 * EARTH_RADIUS)
+    if maxradius >= 0:
+        elevation[distance > maxradius] = numpy.nan
+    return distance, elevation
+
+def viewshed(dem, row, col, nsres, ewres, obs_height, target_height, maxradius, curvature):
+    # Method computing the viewshed of the observer at cell (row, col) of the elevation array dem (nan for null cells). Returns an array of vertical angles of visible cells in degrees (0 down, 90 horizontal, 180 up), nan if a cell is invisible
+    horizon = horizons(dem, row, col, nsres, ewres, [obs_height], maxradius, curvature)[0]
+    distance, elevation = cellgeometry(dem, row, col, nsres, ewres, maxradius, curvature)
+    # The target is visible if its gradient is not below the horizon
+    distance[row, col] = 1
+    target = (elevation + target_height - dem[row, col] - obs_height) / distance
+    with numpy.errstate(invalid = 'ignore'):
+        angles = numpy.where(target >= horizon, 90 + numpy.degrees(numpy.arctan(target)), numpy.nan)
+    angles[row, col] = 180.0
+    return angles
+
+def mintargetheights(dem, row, col, nsres, ewres, obs_heights, maxradius, curvature):
+    # Method computing for each observer height the minimum height above ground at which a target in each cell is visible, from one horizon pass. Returns an array (observer height, row, column), nan for cells beyond maxradius and null cells
+    horizon = horizons(dem, row, col, nsres, ewres, obs_heights, maxradius, curvature)
+    distance, elevation = cellgeometry(dem, row, col, nsres, ewres, maxradius, curvature)
+    eyes = dem[row, col] + numpy.asarray(obs_heights, dtype=float)[:, numpy.newaxis, numpy.newaxis]
+    # A target is visible if its gradient is not below the horizon, i.e. if its top is at least at the horizon line
+    heights = numpy.maximum(horizon * distance + eyes - elevation, 0)
+    heights[:, row, col] = 0
+    return heights
+
+class ViewshedPool:
+    """ ViewshedPool object, runs r.viewshed processes in a limited number of worker slots and reports progress """
+    def __init__(self, workers, n_tasks):
+        self.slots = [None] * workers   # (process, point number, output raster) tuple of each worker, None if the worker is free
+        self.n_tasks = n_tasks
+        self.n_done = 0
+
+    def start(self, pointnumber, outraster, **kwargs):
+        """ Start r.viewshed with given arguments in the first free worker slot, waiting for one if all are busy. Returns a list of (point number, output raster) tuples of viewsheds finished meanwhile """
+        finished = []
+        while None not in self.slots:
+            finished.extend(self.collect())
+            if None not in self.slots:
+                time.sleep(POLL_INTERVAL)
+        self.slots[self.slots.index(None)] = (grass.start_command('r.viewshed', **kwargs), pointnumber, outraster)
+        return finished
+
+    def collect(self):
+        """ Free the slots of finished workers and report progress. Returns a list of (point number, output raster) tuples of finished viewsheds """
+        finished = []
+        for slot, task in enumerate(self.slots):
+            if task is None or task[0].poll() is None:
+                continue
+            process, pointnumber, outraster = task
+            self.slots[slot] = None
+            if process.returncode != 0:
+                grass.run_command('g.remove', rast = outraster, quiet = True)
+                grass.fatal("r.viewshed failed for point " + str(pointnumber))
+            self.n_done += 1
+            grass.verbose("Worker " + str(slot + 1) + ": viewshed of point " + str(pointnumber) + " done")
+            grass.percent(self.n_done, self.n_tasks, 1)
+            finished.append((pointnumber, outraster))
+        return finished
+
+    def wait(self):
+        """ Wait for all workers to finish. Returns a list of (point number, output raster) tuples of viewsheds finished meanwhile """
+        finished = []
+        while any(self.slots):
+            finished.extend(self.collect())
+            if any(self.slots):
+                time.sleep(POLL_INTERVAL)
+        return finished
+
+    def cancel(self):
+        """ Stop all workers and remove their unfinished outputs """
+        for slot, task in enumerate(self.slots):
+            if task is not None:
+                process, pointnumber, outraster = task
+                if process.poll() is None:
+                    process.terminate()
+                    process.wait()
+                grass.run_command('g.remove', rast = outraster, quiet = True)
+                self.slots[slot] = None
         
 if __name__ == "__main__":
     options, flags = grass.parser()
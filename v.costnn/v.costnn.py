@@ -45,27 +45,136 @@
 #% answer: 19
 #%end
 
+#%option
+#% key: engine
+#% type: string
+#% answer: expansion
+#% options: expansion, lcp
+#% description: Nearest neighbour cost method: expansion gives the cost to the cheapest neighbour, with one cost expansion from all points at once; lcp gives the cost to the nearest neighbour by straight-line distance, with r.lcp from each point separately (slow, results of earlier versions of this module)
+#% required: no
+#%end
+
+#%option
+#% key: candidates
+#% type: integer
+#% description: Number of candidate sites for simulations. Cost distances between candidate sites are calculated once and simulated patterns are drawn from them (0 for simulating with v.random)
+#% answer: 0
+#% required: no
+#%end
+
+#%option
+#% key: kfunction
+#% type: string
+#% gisprompt: new_file,file,output
+#% description: Output CSV file of cost distance based K and L functions of input points with simulation envelopes
+#% required: no
+#%end
+
+#%option
+#% key: maxcost
+#% type: double
+#% description: Maximum cost distance for K and L functions
+#% required: no
+#%end
+
+#%option
+#% key: steps
+#% type: integer
+#% description: Number of cost distance thresholds for K and L functions
+#% answer: 50
+#% required: no
+#%end
+
+#%option
+#% key: workers
+#% type: integer
+#% description: Number of simulations run in parallel processes
+#% answer: 1
+#% required: no
+#%end
+
+#%option
+#% key: seed
+#% type: integer
+#% description: Seed for random number generation (every simulation gets its own generator derived from it). Random if not set
+#% required: no
+#%end
+
+#%option
+#% key: tolerance
+#% type: double
+#% description: Adaptive mode: stop when 99% envelope bounds have moved less than this fraction of the envelope width over the last 19 simulations
+#% answer: 0.01
+#% required: no
+#%end
+
+#%flag
+#% key: a
+#% description: Adaptive mode: run simulations only until the envelope is stable or the input pattern is clearly outside it (number of simulations is the maximum)
+#%end
+
+#%flag
+#% key: g
+#% description: Place candidate sites on a regular grid instead of random cells
+#%end
+
 import grass.script as grass
+from grass.script import array as garray
 import grass.lib.gis as gis
 import os, sys
 import math
+import numpy
+import multiprocessing
+
+# Simulation settings and temporary layer names of the current process, set by siminit()
+simstate = dict()
+
+MIN_SIMULATIONS = 19    # Minimum number of simulations in adaptive mode, also the window for checking envelope stability
 
 def main():
     # Input data
     inputlayer = options['points']       # Point layer
     frictionlayer = options['friction']  # Friction layer
     simulations = int(options['simulations']) # Number of simulations
+    engine = options['engine']                # Nearest neighbour cost method
+    candidates = int(options['candidates'])   # Number of candidate sites for simulations
+    adaptive = flags['a']                     # Adaptive number of simulations
+    tolerance = float(options['tolerance'])   # Envelope stability tolerance for adaptive mode
+    kfunction = options['kfunction']          # K and L function output file
+    workers = int(options['workers'])         # Number of parallel simulation processes
+    if kfunction:
+        if not options['maxcost']:
+            grass.fatal("Maximum cost distance is needed for K and L functions")
+        maxcost = float(options['maxcost'])         # Maximum cost distance for K and L functions
+        thresholds = numpy.linspace(maxcost / int(options['steps']), maxcost, int(options['steps']))   # Cost distance thresholds
+    else:
+        maxcost = 0
+        thresholds = None
+    if workers < 1:
+        grass.fatal("The number of workers must be a positive number")
+    # Candidate site costs come from cost expansions, which give the cost to the cheapest neighbour, not to the nearest one as r.lcp does
+    if engine == "lcp" and candidates:
+        grass.fatal("Candidate sites can only be used with the expansion engine")
+    if options['seed']:
+        seed = int(options['seed'])
+    else:
+        seed = numpy.random.RandomState().randint(0, 2**31 - 1)
+        grass.message("Random seed: " + str(seed))
     
     # Create a temporary filename
     pid = os.getpid()
-    costnn = "tmp_costnn_%d" % pid
+    costfile = grass.tempfile() + ".npy"
     randompoints = "tmp_randompoints_%d" % pid
-    
-    # Do the initial lcp vector layer for input point layer
-    grass.run_command("r.lcp", overwrite = True, flags="c", friction = frictionlayer, points = inputlayer, radius = 0, nearpoints = 1, vectout = costnn)
+    costmap = "tmp_costnn_cost_%d" % pid
+    nearmap = "tmp_costnn_nearest_%d" % pid
     
     # Get input point layer nearest neighbour costs
-    maincosts = attributes(costnn, "cost")
+    if engine == "expansion" or candidates or kfunction:
+        expansion = CostExpansion(frictionlayer, costmap, nearmap)
+    if engine == "expansion":
+        maincosts = expansion.nncosts(inputlayer)
+    else:
+        maincosts = lcpcosts(inputlayer, frictionlayer, costfile)
     # Number of points in the input point layer
     n_points = len(maincosts)
     
@@ -73,25 +182,62 @@ def main():
     mainlayer = sum(maincosts)/n_points
     # Create an empty list to hold simulated pattern mean cost distance values
     mc = list()
+    # And another for numbers of point pairs within cost distance thresholds (for K function)
+    mcpairs = list()
 
-    # Monte Carlo loop
-    for i in range(simulations):
-        # Create random points and create lcp-s
-        grass.run_command("v.random", overwrite = True, output = randompoints, n = n_points)
-        grass.run_command("r.lcp", overwrite = True, flags="c", friction = frictionlayer, points = randompoints, radius = 0, nearpoints = 1, vectout = costnn)
-        # Get the mean of distances and add it to the mc list
-        mccosts = attributes(costnn, "cost")
-        mcmean = float(sum(mccosts)) / float(len(mccosts))
+    # Count point pairs within cost distance thresholds, using one cost expansion (bounded by maximum cost) from each point
+    if kfunction:
+        cats, rows, cols = readpoints(inputlayer, expansion.region)
+        mainpairs = paircounts(expansion.costmatrix(rows, cols, maxcost), thresholds)
+        n_main = len(rows)      # Input pairs are counted between all points in the region, also those left out of nearest neighbour costs
+
+    # If candidate sites are used, calculate cost distances between all of them
+    if candidates:
+        if candidates < n_points:
+            grass.fatal("The number of candidate sites must not be smaller than the number of points")
+        rows, cols = expansion.candidatecells(candidates, flags['g'], numpy.random.RandomState(seed))
+        # A grid gives only about the requested number of sites
+        if len(rows) < n_points:
+            grass.fatal("The candidate site grid has only " + str(len(rows)) + " cells with non-null friction, fewer than the number of points. Use more candidate sites")
+        matrix = expansion.costmatrix(rows, cols)
+    else:
+        matrix = None
+
+    # Monte Carlo loop. Simulations are run in worker processes (or in this process if there is only one worker), each worker with its own temporary layers. Every simulation has its own random generator derived from the seed and its number, so results do not depend on the number of workers
+    # Workers number themselves with a shared counter and name their temporary layers after this process and their number, so that they can all be removed at the end, also those of workers stopped before their results were read
+    workerids = multiprocessing.Value('i', 0)
+    initargs = (frictionlayer, engine, n_points, matrix, thresholds, maxcost, pid, workerids)
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, siminit, initargs)
+        results = pool.imap(simulate, [(i, seed) for i in range(simulations)])
+    else:
+        siminit(*initargs)
+        results = (simulate((i, seed)) for i in range(simulations))
+    # The distribution of simulated pattern mean cost distances is updated as simulation results come in
+    mcstats = RunningStats()
+    skipped = 0         # Simulations where no point could reach another
+    for mcmean, pairs in results:
+        if mcmean is None:
+            skipped += 1
+            continue
         mc.append(mcmean)
+        mcpairs.append(pairs)
+        mcstats.add(mcmean)
+        # In adaptive mode stop as soon as the result is clear. Results come in simulation order, so the stopping point does not depend on the number of workers
+        if adaptive and mcstats.converged(mainlayer, tolerance):
+            grass.message("Stopped after " + str(mcstats.count) + " simulations")
+            break
+    if workers > 1:
+        pool.terminate()    # Also stops simulations still running in adaptive mode
+        pool.join()
+    if skipped:
+        grass.warning(str(skipped) + " simulations were skipped, because none of their points could reach another point")
+    if mcstats.count == 0:
+        grass.fatal("No simulation had points that could reach each other")
     
-    # Calculate the distribution for simulated patterns
-    # Get the mean of the distribution of mean simulated pattern cost distances
-    mc_mean = float(sum(mc)) / float(len(mc))
-    # Calculate population standard deviation
-    mc_diff = []
-    for i in mc:
-        mc_diff.append((i - mc_mean)**2)
-    mc_stddev = math.sqrt(float(sum(mc_diff))/float(n_points))
+    # Get the mean and population standard deviation of the distribution of mean simulated pattern cost distances
+    mc_mean = mcstats.mean
+    mc_stddev = mcstats.stddev()
     
     # Get the 95% and 99% upper and lower values
     mc_upper95 = mc_mean + 1.96*mc_stddev
@@ -110,27 +256,217 @@ def main():
     print("Simulated distribution upper 99% value: " + str(mc_upper99))
     print("Simulated distribution lower 99% value: " + str(mc_lower99))
 
+    # Write K and L functions of the input points and simulation envelopes
+    if kfunction:
+        writekfunction(kfunction, thresholds, mainpairs, numpy.array(mcpairs), n_main, n_points, expansion.area)
+
     # Delete temporary files
-    grass.run_command("g.remove", vect = costnn, quiet = True)
     grass.run_command("g.remove", vect = randompoints, quiet = True)
+    grass.run_command("g.remove", rast = costmap + "," + nearmap, quiet = True)
+    for workerid in range(1, workerids.value + 1):
+        grass.run_command("g.remove", vect = "tmp_randompoints_%d_%d" % (pid, workerid), quiet = True)
+        grass.run_command("g.remove", rast = "tmp_costnn_cost_%d_%d,tmp_costnn_nearest_%d_%d" % (pid, workerid, pid, workerid), quiet = True)
 
-def attributes(layer, column):
-    # Method that returns attribute data as a list
-    temp = grass.tempfile()
-    # ... and create and open a new file for writing with that temporary name.
-    layer_temp = file(temp, 'w')
-    # Get vector layer attribute data and write it to layer_temp
-    grass.run_command("v.db.select", flags="c", map=layer, columns=column, stdout = layer_temp)
-    layer_temp.close()
-    
-    # Create a list for holding the attribute values
-    attlist = []
-    # Open the file where attribute data ise stored and write each feature attribute data into the list
-    layer_temp = file(temp)
-    for feat in layer_temp:
-        attlist.append(float(feat))
-    layer_temp.close()
-    return attlist
+class RunningStats:
+    """ RunningStats object, keeps the running mean and variance of simulated values (Welford's algorithm) and the history of 99% envelope bounds """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0           # Sum of squared differences from the mean
+        self.bounds = []        # 99% envelope (lower, upper) bounds after each value
+
+    def add(self, value):
+        """ Add a simulated value """
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.bounds.append((self.mean - 2.58 * self.stddev(), self.mean + 2.58 * self.stddev()))
+
+    def stddev(self):
+        """ Population standard deviation of values """
+        return math.sqrt(self.m2 / self.count)
+
+    def converged(self, observed, tolerance):
+        """ Returns True if (after at least MIN_SIMULATIONS values) the 99% envelope bounds have moved less than tolerance * envelope width over the last MIN_SIMULATIONS values, or the observed value is outside the envelope by more than the standard error of the bounds """
+        if self.count <= MIN_SIMULATIONS:
+            return False
+        lower, upper = self.bounds[-1]
+        lower_old, upper_old = self.bounds[-1 - MIN_SIMULATIONS]
+        if max(abs(lower - lower_old), abs(upper - upper_old)) < tolerance * (upper - lower):
+            return True
+        bound_se = self.stddev() * math.sqrt((1 + 2.58**2 / 2.0) / self.count)   # Approximate standard error of mean + 2.58 * stddev
+        return observed > upper + 2.58 * bound_se or observed < lower - 2.58 * bound_se
+
+def siminit(friction, engine, n_points, matrix, thresholds, maxcost, parentpid, workerids):
+    # Method setting up the simulation state of a process: settings, temporary layer names unique to the process (after the main process id and a worker number taken from the shared counter workerids) and cost expansion object
+    with workerids.get_lock():
+        workerids.value += 1
+        suffix = "%d_%d" % (parentpid, workerids.value)
+    simstate['friction'] = friction
+    simstate['engine'] = engine
+    simstate['n_points'] = n_points
+    simstate['matrix'] = matrix     # Candidate site cost matrix, None if v.random is used
+    simstate['thresholds'] = thresholds     # K function cost distance thresholds, None if not needed
+    simstate['maxcost'] = maxcost
+    simstate['costfile'] = grass.tempfile() + ".npy"
+    simstate['randompoints'] = "tmp_randompoints_" + suffix
+    if matrix is None and (engine == "expansion" or thresholds is not None):
+        simstate['expansion'] = CostExpansion(friction, "tmp_costnn_cost_" + suffix, "tmp_costnn_nearest_" + suffix)
+
+def simulate(task):
+    # Method running one simulation with the number and seed given in task tuple. Returns the mean nearest neighbour cost of the simulated pattern and numbers of point pairs within K function thresholds (None if not needed), or None and None if no point could reach another
+    i, seed = task
+    rng = numpy.random.RandomState([seed, i])   # Random generator of this simulation
+    n_points = simstate['n_points']
+    thresholds = simstate['thresholds']
+    pairs = None
+    # Draw a simulated pattern from candidate sites and look up the costs
+    if simstate['matrix'] is not None:
+        sites = rng.permutation(simstate['matrix'].shape[0])[:n_points]
+        mccosts = matrixnncosts(simstate['matrix'], sites)
+        if thresholds is not None:
+            pairs = paircounts(simstate['matrix'][numpy.ix_(sites, sites)], thresholds)
+    else:
+        # Create random points and get their costs
+        randompoints = simstate['randompoints']
+        grass.run_command("v.random", overwrite = True, quiet = True, output = randompoints, n = n_points, seed = rng.randint(0, 2**31 - 1))
+        if simstate['engine'] == "expansion":
+            mccosts = simstate['expansion'].nncosts(randompoints)
+        else:
+            mccosts = lcpcosts(randompoints, simstate['friction'], simstate['costfile'])
+        if thresholds is not None:
+            expansion = simstate['expansion']
+            cats, rows, cols = readpoints(randompoints, expansion.region)
+            pairs = paircounts(expansion.costmatrix(rows, cols, simstate['maxcost'], progress = False), thresholds)
+    # Get the mean of distances. If no point could reach another (e.g. all sites on separate friction islands), the simulation has no result
+    if len(mccosts) == 0:
+        return None, None
+    mcmean = float(sum(mccosts)) / float(len(mccosts))
+    return mcmean, pairs
+
+def paircounts(matrix, thresholds):
+    # Method returning an array of numbers of ordered point pairs (i, j), i != j, with cost distance not over each threshold, from the cost matrix of the points
+    costs = matrix[~numpy.eye(matrix.shape[0], dtype = bool)]
+    return numpy.searchsorted(numpy.sort(costs), thresholds, side = "right")
+
+def writekfunction(filename, thresholds, mainpairs, mcpairs, n_main, n_points, area):
+    # Method writing K and L functions of input points, mean of simulated L functions and their minimum and maximum (envelope) into a CSV file. K(c) = area * pairs(c) / (n * (n - 1)), where n is the number of points the pairs were counted from: n_main input points, n_points points in simulated patterns. L(c) = sqrt(K(c) / pi)
+    main_k = area / (n_main * (n_main - 1.0)) * mainpairs
+    mc_l = numpy.sqrt(area / (n_points * (n_points - 1.0)) * mcpairs / math.pi)
+    csv = open(filename, "w")
+    csv.write("cost,k,l,l_mean,l_lower,l_upper\n")
+    for i in range(len(thresholds)):
+        values = [thresholds[i], main_k[i], math.sqrt(main_k[i] / math.pi), mc_l[:,i].mean(), mc_l[:,i].min(), mc_l[:,i].max()]
+        csv.write(",".join([str(value) for value in values]) + "\n")
+    csv.close()
+
+def lcpcosts(points, friction, costfile):
+    # Method returning nearest neighbour costs of a point layer as an array, using r.lcp to calculate the least cost path cost to the nearest point from each point. r.lcp writes the costs into a binary file, so no vector layer or attribute table is created
+    grass.run_command("r.lcp", overwrite = True, quiet = True, friction = friction, points = points, radius = 0, nearpoints = 1, costout = costfile)
+    costs = numpy.load(costfile)[:,2]
+    os.remove(costfile)
+    return costs
+
+
+def readpoints(layer, region):
+    # Method returning arrays of categories, rows and columns of layer points that are inside the region
+    ascii = grass.read_command("v.out.ascii", input = layer, type = "point", format = "point", separator = "|")
+    values = numpy.array([line.split("|")[:3] for line in ascii.splitlines() if line.strip()], dtype = numpy.float64).reshape(-1, 3)
+    rows = numpy.floor((region['n'] - values[:,1]) / region['nsres']).astype(int)
+    cols = numpy.floor((values[:,0] - region['w']) / region['ewres']).astype(int)
+    inside = (rows >= 0) & (rows < region['rows']) & (cols >= 0) & (cols < region['cols'])
+    return values[inside,2].astype(int), rows[inside], cols[inside]
+
+
+class CostExpansion:
+    """ CostExpansion object, calculates cost distances with r.cost on a friction map that is read into memory once. Costs are in the same units as in r.lcp (cost surface values multiplied by region resolution) """
+    def __init__(self, friction, costmap, nearmap):
+        self.friction = friction
+        self.costmap = costmap      # Temporary cost surface layer name
+        self.nearmap = nearmap      # Temporary nearest start point layer name
+        self.region = grass.region()
+        self.regionres = (self.region['nsres'] + self.region['ewres']) / 2.0
+        # Read the friction map into memory (NULL cells become -1, i.e. impassable) and create arrays for cost surfaces
+        self.frictiondata = garray.array()
+        self.frictiondata.read(friction, null = -1)
+        self.area = (self.frictiondata >= 0).sum() * self.region['nsres'] * self.region['ewres']   # Area of non-null friction cells
+        self.costdata = garray.array()
+        self.neardata = garray.array(dtype = numpy.int32)
+        # Moves between neighbouring cells as (row step, column step, factor) tuples. Factors are the ones r.cost uses: moves are in east-west cell units and each move costs the mean of the two cells' friction values
+        ns = self.region['nsres'] / self.region['ewres']
+        self.moves = [(0, 1, 1.0), (1, 0, ns), (1, 1, math.sqrt(1 + ns**2)), (1, -1, math.sqrt(1 + ns**2))]
+
+    def nncosts(self, points):
+        """ Returns an array of nearest neighbour costs of the point layer points, using one cost expansion from all points at once. Every cell is labelled with its nearest point; the cheapest path from a point to its nearest neighbour must cross the border of its cell group, so the nearest neighbour cost is the minimum of cost(a) + move(a,b) + cost(b) over neighbouring cells a and b that belong to different points """
+        cats, rows, cols = readpoints(points, self.region)
+        grass.run_command("r.cost", overwrite = True, quiet = True, input = self.friction, output = self.costmap, nearest = self.nearmap, start_points = points)
+        self.costdata.read(self.costmap, null = -1)
+        self.neardata.read(self.nearmap, null = 0)
+        best = numpy.empty(max(cats.max(), self.neardata.max()) + 1)
+        best.fill(numpy.inf)
+        n_rows, n_cols = self.costdata.shape
+        for dr, dc, fac in self.moves:
+            # Cell a and its neighbour b for all cells at once
+            a = (slice(0, n_rows - dr), slice(max(0, -dc), n_cols - max(0, dc)))
+            b = (slice(dr, n_rows), slice(max(0, dc), n_cols - max(0, -dc)))
+            near_a, near_b = self.neardata[a], self.neardata[b]
+            cost_a, cost_b = self.costdata[a], self.costdata[b]
+            fric_a, fric_b = self.frictiondata[a], self.frictiondata[b]
+            border = (near_a != near_b) & (near_a > 0) & (near_b > 0) & (cost_a >= 0) & (cost_b >= 0) & (fric_a >= 0) & (fric_b >= 0)
+            total = cost_a[border] + cost_b[border] + (fric_a[border] + fric_b[border]) * fac / 2.0
+            numpy.minimum.at(best, near_a[border], total)
+            numpy.minimum.at(best, near_b[border], total)
+        costs = best[cats]
+        # Points sharing a cell with another point have zero cost to their nearest neighbour
+        cells = rows * n_cols + cols
+        costs[numpy.bincount(cells)[cells] > 1] = 0
+        if numpy.isinf(costs).any():
+            grass.warning("Some points cannot reach any other point and are left out")
+            costs = costs[~numpy.isinf(costs)]
+        return costs * self.regionres
+
+    def candidatecells(self, n_sites, grid, rng):
+        """ Returns arrays of rows and columns of n_sites (about as many if on a grid) candidate site cells with non-null friction, either on a regular grid or randomly selected """
+        valid = self.frictiondata >= 0
+        n_valid = int(valid.sum())
+        if n_valid < n_sites:
+            grass.fatal("There are fewer non-null cells than candidate sites")
+        if grid:
+            # Grid spacing that gives about n_sites valid cells, cells are in the middle of grid squares
+            step = max(1, int(math.ceil(math.sqrt(float(n_valid) / n_sites))))
+            gridmask = numpy.zeros(valid.shape, dtype = bool)
+            gridmask[step // 2::step, step // 2::step] = True
+            rows, cols = numpy.nonzero(valid & gridmask)
+            return rows, cols
+        rows, cols = numpy.nonzero(valid)
+        sites = rng.permutation(n_valid)[:n_sites]
+        return rows[sites], cols[sites]
+
+    def costmatrix(self, rows, cols, maxcost=0, progress=True):
+        """ Returns a matrix of cost distances between all cells given as arrays of rows and columns (infinity if unreachable or over maxcost), with one cost expansion from each cell. Expansions stop at maxcost if it is given """
+        n_sites = len(rows)
+        matrix = numpy.empty((n_sites, n_sites))
+        for i in range(n_sites):
+            if progress:
+                grass.percent(i, n_sites, 1)
+            x = self.region['w'] + (cols[i] + 0.5) * self.region['ewres']
+            y = self.region['n'] - (rows[i] + 0.5) * self.region['nsres']
+            grass.run_command("r.cost", overwrite = True, quiet = True, input = self.friction, output = self.costmap, start_coordinates = str(x) + "," + str(y), max_cost = maxcost / self.regionres)
+            self.costdata.read(self.costmap, null = -1)
+            matrix[i] = self.costdata[rows, cols]
+        if progress:
+            grass.percent(n_sites, n_sites, 1)
+        matrix[matrix < 0] = numpy.inf
+        return matrix * self.regionres
+
+
+def matrixnncosts(matrix, sites):
+    # Method returning nearest neighbour costs of a pattern of candidate sites (list of indices) from the candidate site cost matrix
+    costs = matrix[numpy.ix_(sites, sites)]
+    numpy.fill_diagonal(costs, numpy.inf)
+    costs = costs.min(axis = 1)
+    return costs[~numpy.isinf(costs)]
 
 
 if __name__ == "__main__":